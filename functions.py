@@ -1,43 +1,132 @@
 import contextlib
+import errno
+import fcntl
+import fnmatch
+import functools
+import glob
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import re
+import resource
+import shlex
+import stat
 import subprocess
 import sys
+import tarfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, replace
 from pathlib import Path
-from threading import Thread
+from types import MappingProxyType
+from threading import Lock, Thread
 from time import sleep
 
 
 #######################################################################################
 #                               PATHLIB FUNCTIONS                                     #
 #######################################################################################
-# unlink all files in a directory and remove the directory
-def rmdir(rm_dir: str, keep_dir: bool = True) -> None:
-    def unlink_files(path_to_rm: Path) -> None:
-        try:
-            for file in path_to_rm.iterdir():
-                if file.is_file():
-                    file.unlink()
-                else:
-                    unlink_files(path_to_rm)
-        except FileNotFoundError:
-            print(f"Couldn't remove non existent directory: {path_to_rm}, ignoring")
+# Every path on the system being set up goes through host_path(), so the script can also work
+# on a mounted OS image (or a synthetic root for benchmarking). Paths inside this repo and the
+# cache are never rerooted.
+root = "/"
+
+
+def set_root(path: str) -> None:
+    global root
+    root = os.path.abspath(path)
+
+
+def root_dir() -> str:
+    return root
+
+
+def host_path(path: str) -> str:
+    if root == "/":
+        return path
+    return os.path.join(root, path.lstrip("/"))
+
+
+# the path inside the root of a host_path(), None if it is outside of the root
+def root_path(path: str):
+    path = os.path.abspath(path)
+    if root == "/":
+        return path
+    if path != root and not path.startswith(root + "/"):
+        return None
+    return "/" + os.path.relpath(path, root).removeprefix(".")
+
+
+# remove everything under a directory (and the directory itself unless keep_dir), returns how many
+# (files, directories) were removed. Walks with an explicit stack of open directory fds and only
+# uses names relative to them, opened with O_NOFOLLOW: a directory swapped for a symlink halfway
+# is unlinked instead of followed, so nothing outside rm_dir can be removed. Symlinks themselves
+# are removed, never what they point to
+def rmdir(rm_dir: str, keep_dir: bool = True) -> tuple:
+    flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+    files = dirs = 0
+
+    def unlink(name, dir_fd, path):
+        nonlocal files
+        journal_change(os.path.join(path, name))
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(name, dir_fd=dir_fd)
+            files += 1
+
+    # remove everything but directories right away, return the directories left to descend into
+    def scan(dir_fd, path):
+        with os.scandir(dir_fd) as it:
+            entries = list(it)
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                unlink(entry.name, dir_fd, path)
+        return iter([entry.name for entry in entries if entry.is_dir(follow_symlinks=False)])
 
-    # convert string to Path object
-    rm_dir_as_path = Path(rm_dir)
     try:
-        unlink_files(rm_dir_as_path)
-    except RecursionError:  # python doesn't work for folders with a lot of subfolders
-        print(f"Failed to remove {rm_dir} with python, using bash")
-        bash(f"rm -rf {rm_dir_as_path.absolute().as_posix()}/*")
-    # Remove emtpy directory
+        top_fd = os.open(rm_dir, flags)
+    except (FileNotFoundError, NotADirectoryError):
+        return 0, 0
+    stack = [(top_fd, rm_dir, scan(top_fd, rm_dir))]
+    try:
+        while stack:
+            dir_fd, path, subdirs = stack[-1]
+            for name in subdirs:
+                try:
+                    child_fd = os.open(name, flags, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    continue
+                except OSError:
+                    # replaced by a symlink or a file since it was listed
+                    unlink(name, dir_fd, path)
+                    continue
+                child_path = os.path.join(path, name)
+                stack.append((child_fd, child_path, scan(child_fd, child_path)))
+                break
+            else:
+                stack.pop()
+                os.close(dir_fd)
+                if stack:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.rmdir(os.path.basename(path), dir_fd=stack[-1][0])
+                        dirs += 1
+    finally:
+        for dir_fd, path, subdirs in stack:
+            os.close(dir_fd)
     if not keep_dir:
-        try:
-            rm_dir_as_path.rmdir()
-        except FileNotFoundError:  # Directory doesn't exist, because bash was used
-            return
+        with contextlib.suppress(FileNotFoundError):
+            os.rmdir(rm_dir)
+            dirs += 1
+    return files, dirs
 
 
 # remove a single file
 def rmfile(file: str, force: bool = False) -> None:
+    if os.path.lexists(file):
+        journal_change(file)
     if force:  # for symbolic links
         Path(file).unlink(missing_ok=True)
     file_as_path = Path(file)
@@ -49,45 +138,599 @@ def rmfile(file: str, force: bool = False) -> None:
 def mkdir(mk_dir: str, create_parents: bool = False) -> None:
     mk_dir_as_path = Path(mk_dir)
     if not mk_dir_as_path.exists():
-        mk_dir_as_path.mkdir(parents=create_parents)
+        if journal is not None:
+            missing = [mk_dir_as_path] + [parent for parent in mk_dir_as_path.parents if not parent.exists()]
+            for path in reversed(missing):
+                journal_change(str(path))
+        mk_dir_as_path.mkdir(parents=create_parents, exist_ok=True)
 
 
 def path_exists(path_str: str) -> bool:
     return Path(path_str).exists()
 
 
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+#######################################################################################
+#                                 FILE SYNC FUNCTIONS                                 #
+#######################################################################################
+# Files are only rewritten when they actually changed: size+mtime is compared first, then the
+# content hash. Copies go through a temp file and an atomic rename, so a half written file is
+# never visible, and are done in the kernel with copy_file_range/sendfile where possible.
+COPY_CHUNK = 8 * 1024 * 1024
+
+
+@dataclass
+class SyncStats:
+    copied: int = 0
+    skipped: int = 0
+    copied_bytes: int = 0
+    skipped_bytes: int = 0
+
+
+sync_stats = SyncStats()
+sync_stats_lock = Lock()
+
+
+def record_sync(copied: bool, size: int) -> None:
+    with sync_stats_lock:
+        if copied:
+            sync_stats.copied += 1
+            sync_stats.copied_bytes += size
+        else:
+            sync_stats.skipped += 1
+            sync_stats.skipped_bytes += size
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def print_sync_summary() -> None:
+    print_status(f"Copied {sync_stats.copied} files ({format_size(sync_stats.copied_bytes)}), "
+                 f"skipped {sync_stats.skipped} unchanged files ({format_size(sync_stats.skipped_bytes)})")
+
+
+# copy the contents of one fd into another, in the kernel when possible
+def copy_fd(fd_in: int, fd_out: int, size: int) -> None:
+    copied = 0
+    for copy in (os.copy_file_range, os.sendfile):
+        try:
+            while copied < size:
+                if copy is os.sendfile:
+                    sent = os.sendfile(fd_out, fd_in, copied, min(COPY_CHUNK, size - copied))
+                else:
+                    sent = os.copy_file_range(fd_in, fd_out, min(COPY_CHUNK, size - copied), copied, copied)
+                if sent == 0:
+                    break
+                copied += sent
+        except OSError:
+            # not supported for this file system/kernel, try the next method
+            pass
+        if copied == size:
+            return
+        # copy_file_range uses explicit offsets and doesn't move fd_out, sendfile and write continue at its position
+        os.lseek(fd_out, copied, os.SEEK_SET)
+    # plain read/write fallback
+    os.lseek(fd_in, copied, os.SEEK_SET)
+    while copied < size and (chunk := os.read(fd_in, min(COPY_CHUNK, size - copied))):
+        os.write(fd_out, chunk)
+        copied += len(chunk)
+    if copied < size:
+        raise OSError(errno.EIO, f"short copy, {copied} of {size} bytes")
+
+
+# temp file name next to path, unique per process and thread (steps and compression jobs run in threads)
+def tmp_name(path: str) -> str:
+    return os.path.join(os.path.dirname(path) or ".", f".{os.path.basename(path)}.tmp-{os.getpid()}-{threading.get_ident()}")
+
+
+# write src to dst through a temp file in the same directory and an atomic rename
+def copy_file_atomic(src: str, dst: str, src_stat: os.stat_result) -> None:
+    journal_change(dst)
+    tmp = tmp_name(dst)
+    fd_in = os.open(src, os.O_RDONLY)
+    try:
+        fd_out = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            copy_fd(fd_in, fd_out, src_stat.st_size)
+            os.fchmod(fd_out, src_stat.st_mode & 0o7777)
+            os.utime(fd_out, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        finally:
+            os.close(fd_out)
+        os.replace(tmp, dst)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+    finally:
+        os.close(fd_in)
+
+
+# copy a single file unless dst already has the same content, returns True if it was copied
+def sync_file(src: str, dst: str) -> bool:
+    src_stat = os.stat(src)
+    try:
+        dst_stat = os.lstat(dst)
+    except FileNotFoundError:
+        dst_stat = None
+    if dst_stat and stat.S_ISREG(dst_stat.st_mode) and dst_stat.st_size == src_stat.st_size:
+        if dst_stat.st_mtime_ns == src_stat.st_mtime_ns or sha256_file(src) == sha256_file(dst):
+            if dst_stat.st_mtime_ns != src_stat.st_mtime_ns:
+                # same content, sync the mtime so the next run takes the fast path
+                os.utime(dst, ns=(dst_stat.st_atime_ns, src_stat.st_mtime_ns))
+            record_sync(False, src_stat.st_size)
+            return False
+    copy_file_atomic(src, dst, src_stat)
+    record_sync(True, src_stat.st_size)
+    return True
+
+
+# recreate a symlink unless dst already points at the same target, returns True if it changed
+def sync_symlink(src: str, dst: str) -> bool:
+    target = os.readlink(src)
+    with contextlib.suppress(OSError):
+        if os.readlink(dst) == target:
+            record_sync(False, 0)
+            return False
+    symlink(target, dst)
+    record_sync(True, 0)
+    return True
+
+
+# write data to a file through a temp file and an atomic rename
+def write_file_atomic(dst: str, data: bytes, mode: int = 0o644) -> None:
+    journal_change(dst)
+    tmp = tmp_name(dst)
+    try:
+        with open(tmp, "wb") as file:
+            file.write(data)
+            os.fchmod(file.fileno(), mode)
+        os.replace(tmp, dst)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+# write data to dst unless it already has exactly that content, returns True if it was written
+def sync_data(dst: str, data: bytes, mode: int = 0o644) -> bool:
+    with contextlib.suppress(FileNotFoundError, IsADirectoryError):
+        if os.lstat(dst).st_size == len(data):
+            with open(dst, "rb") as file:
+                if file.read() == data:
+                    record_sync(False, len(data))
+                    return False
+    write_file_atomic(dst, data, mode)
+    record_sync(True, len(data))
+    return True
+
+
+# ln -sf, but atomic: the link is created next to dst and renamed over it
+def symlink(target: str, dst: str) -> None:
+    journal_change(dst)
+    tmp = tmp_name(dst)
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, dst)
+
+
+# recursively sync a directory tree into another one
+def sync_tree(src: str, dst: str) -> None:
+    for root, dirs, files in os.walk(src):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        mkdir(dst_root, create_parents=True)
+        for name in dirs:
+            # os.walk doesn't descend into symlinked directories, they are copied as links
+            if os.path.islink(os.path.join(root, name)):
+                sync_symlink(os.path.join(root, name), os.path.join(dst_root, name))
+        for name in files:
+            if os.path.islink(os.path.join(root, name)):
+                sync_symlink(os.path.join(root, name), os.path.join(dst_root, name))
+            else:
+                sync_file(os.path.join(root, name), os.path.join(dst_root, name))
+
+
 # recursively copy files from a dir into another dir
 def cpdir(src_as_str: str, dst_as_string: str) -> None:  # dst_dir must be a full path, including the new dir name
     src_as_path = Path(src_as_str)
-    dst_as_path = Path(dst_as_string)
     if src_as_path.exists():
-        if not dst_as_path.exists():
-            mkdir(dst_as_string)
-        bash(f"cp -rp {src_as_path.absolute().as_posix()}/* {dst_as_path.absolute().as_posix()}")
+        sync_tree(src_as_str, dst_as_string)
     else:
         raise FileNotFoundError(f"No such directory: {src_as_path.absolute().as_posix()}")
 
 
 def cpfile(src_as_str: str, dst_as_str: str) -> None:  # "/etc/resolv.conf", "/var/some_config/resolv.conf"
     src_as_path = Path(src_as_str)
-    dst_as_path = Path(dst_as_str)
     if src_as_path.exists():
-        dst_as_path.write_bytes(src_as_path.read_bytes())
+        sync_file(src_as_str, dst_as_str)
     else:
         raise FileNotFoundError(f"No such file: {src_as_path.absolute().as_posix()}")
 
 
+# copy a list of files (relative to src_root) into dst_root, keeping symlinks as symlinks
+def cpfiles(src_root: str, dst_root: str, rel_paths) -> None:
+    for rel_path in rel_paths:
+        src = os.path.join(src_root, rel_path)
+        dst = os.path.join(dst_root, rel_path)
+        mkdir(os.path.dirname(dst), create_parents=True)
+        if os.path.islink(src):
+            sync_symlink(src, dst)
+        else:
+            sync_file(src, dst)
+
+
+#######################################################################################
+#                                      JOURNAL                                        #
+#######################################################################################
+# Every path the setup changes is recorded in a journal before it is touched, together with a
+# backup of what was there. Backups are hardlinks where possible: files are only ever replaced
+# through a rename, so the old inode stays as it was. Across file systems they are reflinks, or
+# copies as a last resort. --rollback puts the recorded state back without reinstalling anything.
+# Each run gets its own directory with one json line per changed path. Lines are written before
+# the change, so a run that died halfway can be rolled back too.
+JOURNAL_DIR = "/var/lib/chromebook-linux-audio/journal"
+JOURNAL_KEEP = 10  # runs of each kind
+# runs of --reconcile/--verify/--install-hooks, kept apart so the hooks can't push the setup runs out
+RECONCILE_RUN_SUFFIX = "-reconcile"
+FICLONE = 0x40049409
+
+journal = None
+
+
+# hardlink, reflink or copy src to dst (which must not exist)
+def backup_file(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    fd_in = os.open(src, os.O_RDONLY)
+    try:
+        src_stat = os.fstat(fd_in)
+        fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            try:
+                fcntl.ioctl(fd_out, FICLONE, fd_in)
+            except OSError:
+                copy_fd(fd_in, fd_out, src_stat.st_size)
+            os.fchmod(fd_out, src_stat.st_mode & 0o7777)
+            os.utime(fd_out, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+
+
+class Journal:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.seen = set()
+        self.changes = 0
+        os.makedirs(path)
+        self.file = open(os.path.join(path, "journal.jsonl"), "w")
+
+    # remember what is at path now, the first time it is about to change in this run
+    def record(self, path: str) -> None:
+        with self.lock:
+            if path in self.seen:
+                return
+            self.seen.add(path)
+            entry = {"path": root_path(path)}
+            try:
+                path_stat = os.lstat(path)
+            except FileNotFoundError:
+                entry["kind"] = "missing"
+            else:
+                if stat.S_ISLNK(path_stat.st_mode):
+                    entry.update(kind="link", target=os.readlink(path))
+                elif stat.S_ISDIR(path_stat.st_mode):
+                    # directories that already exist are never removed
+                    return
+                else:
+                    backup = str(self.changes)
+                    backup_file(path, os.path.join(self.path, backup))
+                    entry.update(kind="file", backup=backup)
+            self.changes += 1
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+        if self.changes == 0:
+            rmdir(self.path, keep_dir=False)
+
+
+# record a path in the journal of this run, if there is one. The cache and the journal itself
+# aren't part of the system being set up
+def journal_change(path: str) -> None:
+    if journal is None:
+        return
+    path = os.path.abspath(path)
+    if root_path(path) is None:
+        return
+    for excluded in (cache_root(), host_path(JOURNAL_DIR)):
+        if path == excluded or path.startswith(excluded + "/"):
+            return
+    journal.record(path)
+
+
+def journal_runs() -> list:
+    try:
+        return sorted(entry.name for entry in os.scandir(host_path(JOURNAL_DIR)) if entry.is_dir())
+    except FileNotFoundError:
+        return []
+
+
+def start_journal(reconcile: bool = False) -> None:
+    global journal
+    runs = [run for run in journal_runs() if run.endswith(RECONCILE_RUN_SUFFIX) == reconcile]
+    for run in runs[:max(len(runs) - JOURNAL_KEEP + 1, 0)]:
+        rmdir(os.path.join(host_path(JOURNAL_DIR), run), keep_dir=False)
+    name = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}" + (RECONCILE_RUN_SUFFIX if reconcile else "")
+    journal = Journal(os.path.join(host_path(JOURNAL_DIR), name))
+
+
+def finish_journal() -> None:
+    global journal
+    if journal is None:
+        return
+    journal.close()
+    if journal.changes:
+        print_status(f"Recorded {journal.changes} changes, undo them with --rollback")
+    journal = None
+
+
+# put back what a run changed, newest change first
+def rollback_run(run_dir: str) -> int:
+    entries = []
+    with open(os.path.join(run_dir, "journal.jsonl")) as file:
+        for line in file:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # the run died while writing this line, the change after it never happened
+                break
+    for entry in reversed(entries):
+        path = host_path(entry["path"])
+        # the directory may have been removed with everything in it
+        if entry["kind"] in ("file", "link"):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if entry["kind"] == "file":
+            backup = os.path.join(run_dir, entry["backup"])
+            tmp = tmp_name(path)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+            try:
+                os.link(backup, tmp)
+                os.replace(tmp, path)
+            except OSError:
+                copy_file_atomic(backup, path, os.stat(backup))
+        elif entry["kind"] == "link":
+            symlink(entry["target"], path)
+        elif os.path.isdir(path) and not os.path.islink(path):
+            # only remove directories this run created if nothing else was put in them since
+            with contextlib.suppress(OSError):
+                os.rmdir(path)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+    rmdir(run_dir, keep_dir=False)
+    return len(entries)
+
+
+# undo the last run, or every run since (and including) the given one
+def rollback(run: str = None) -> None:
+    runs = journal_runs()
+    if not runs:
+        print_error("There is nothing to roll back")
+        exit(1)
+    if run and run not in runs:
+        print_error(f"Unknown run {run}, recorded runs: {', '.join(runs)}")
+        exit(1)
+    for name in reversed(runs[runs.index(run) if run else -1:]):
+        changes = rollback_run(os.path.join(host_path(JOURNAL_DIR), name))
+        print_status(f"Rolled back {changes} changes of run {name}")
+
 #######################################################################################
 #                               BASH FUNCTIONS                                        #
 #######################################################################################
 
-# return the output of a command
-def bash(command: str) -> str:
+# number of external processes started by this run, everything else is done in-process
+external_processes = 0
+
+
+def count_process() -> None:
+    global external_processes
+    with sync_stats_lock:
+        external_processes += 1
+
+
+def spawned_processes() -> int:
+    return external_processes
+
+
+# run a program (no shell) and return its output, None if it failed
+# capture_stderr prints the command's stderr through sys.stdout, so it ends up in the output of the step running it
+# a command still running after timeout seconds is killed and counts as failed
+def run(args: list, check: bool = True, quiet: bool = False, capture_stderr: bool = False, timeout: float = None) -> str:
+    count_process()
+    start = tracer.now() if tracer is not None else 0
+    returncode = 0
+    stderr = subprocess.DEVNULL if quiet else subprocess.PIPE if capture_stderr else None
+    try:
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=stderr, text=True, check=check, timeout=timeout)
+        returncode = result.returncode
+        if result.stderr:
+            print(result.stderr, end="")
+        return result.stdout.strip()
+    except subprocess.CalledProcessError as e:
+        returncode = e.returncode
+        if e.stderr:
+            print(e.stderr, end="")
+        print(f"failed to run command: {' '.join(args)}")
+    except subprocess.TimeoutExpired:
+        returncode = -1
+        print(f"command timed out after {timeout}s: {' '.join(args)}")
+    except OSError:
+        returncode = -1
+        print(f"failed to run command: {' '.join(args)}")
+    finally:
+        if tracer is not None:
+            tracer.command(" ".join(args), start, returncode)
+
+
+#######################################################################################
+#                                      TRACING                                        #
+#######################################################################################
+# --trace FILE records every step and external command as Chrome trace events
+# (load the file in chrome://tracing or ui.perfetto.dev) and prints a summary at the end.
+# When tracing is off, tracer is None and the only cost is that check.
+tracer = None
+
+
+# per-thread counters: cpu time and i/o syscalls/bytes
+def thread_counters() -> dict:
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    counters = {"cpu": usage.ru_utime + usage.ru_stime}
+    for line in read_host_file("/proc/thread-self/io").splitlines():
+        key, _, value = line.partition(":")
+        if key in ("syscr", "syscw", "rchar", "wchar"):
+            counters[key] = int(value)
+    return counters
+
+
+class Tracer:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.lock = Lock()
+
+    # microseconds since the trace started
+    def now(self) -> float:
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def add(self, name: str, category: str, start: float, args: dict) -> None:
+        event = {"name": name, "cat": category, "ph": "X", "ts": round(start, 1), "dur": round(self.now() - start, 1),
+                 "pid": self.pid, "tid": threading.get_native_id(), "args": args}
+        with self.lock:
+            self.events.append(event)
+
+    def command(self, command: str, start: float, returncode: int) -> None:
+        self.add(command, "command", start, {"exit_code": returncode})
+
+    # wrap a top level step, recording wall time, cpu time and i/o of the thread running it
+    def step(self, name: str, func, *args):
+        before = thread_counters()
+        start = self.now()
+        try:
+            return func(*args)
+        finally:
+            after = thread_counters()
+            self.add(name, "step", start, {key: round(after[key] - before[key], 6) for key in after if key in before})
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file)
+
+    def summary(self) -> str:
+        lines = [f"{'step':<24}{'wall ms':>10}{'cpu ms':>10}{'reads':>8}{'writes':>8}"]
+        for event in self.events:
+            if event["cat"] == "step":
+                args = event["args"]
+                lines.append(f"{event['name']:<24}{event['dur'] / 1000:>10.1f}{args.get('cpu', 0) * 1000:>10.1f}"
+                             f"{args.get('syscr', 0):>8}{args.get('syscw', 0):>8}")
+        commands = [event for event in self.events if event["cat"] == "command"]
+        if commands:
+            lines.append(f"{len(commands)} external commands, {sum(event['dur'] for event in commands) / 1000:.1f} ms total")
+            for event in sorted(commands, key=lambda event: event["dur"], reverse=True)[:5]:
+                lines.append(f"  {event['dur'] / 1000:>8.1f} ms  exit {event['args']['exit_code']:<4} {event['name'][:60]}")
+        return "\n".join(lines)
+
+
+def start_trace() -> None:
+    global tracer
+    tracer = Tracer()
+
+
+def finish_trace(path: str) -> None:
+    if tracer is None:
+        return
+    tracer.write(path)
+    print_header("Trace summary")
+    print(tracer.summary())
+    print_status(f"Wrote trace to {path}")
+
+
+#######################################################################################
+#                               COMPRESSION FUNCTIONS                                 #
+#######################################################################################
+# zstd is optional: python 3.14 ships it, older versions need the zstandard module.
+# Without either, the zstd binary is used.
+try:
+    from compression import zstd as zstd_module
+except ImportError:
     try:
-        output = subprocess.check_output(command, shell=True, text=True).strip()
-        return output
-    except:
-        print(f"failed to run command: {command}")
+        import zstandard as zstd_module
+    except ImportError:
+        zstd_module = None
+
+ZSTD_LEVEL = 3  # zstd's own default
+XZ_PRESET = 6  # xz's own default
+
+
+# the kernel's xz decoder only reliably supports crc32 checks (see the kernel firmware docs)
+def xz_compress(src: str, dst: str, preset: int = XZ_PRESET) -> None:
+    with open(src, "rb") as file:
+        data = file.read()
+    write_file_atomic(dst, lzma.compress(data, check=lzma.CHECK_CRC32, preset=preset))
+
+
+def zstd_compress(src: str, dst: str, level: int = ZSTD_LEVEL) -> None:
+    if zstd_module is not None:
+        with open(src, "rb") as file:
+            data = file.read()
+        write_file_atomic(dst, zstd_module.compress(data, level=level))
+        return
+    tmp = tmp_name(dst)
+    if run(["zstd", "-q", "-f", f"-{level}", src, "-o", tmp]) is None:
+        rmfile(tmp)
+        return
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, dst)
+
+
+# suffix -> (compress function, level)
+COMPRESSORS = {
+    "xz": (xz_compress, XZ_PRESET),
+    "zst": (zstd_compress, ZSTD_LEVEL),
+}
+
+
+# compress a file into the cache, keyed by its hash and the codec/level, and return the cached path
+# (None if it couldn't be compressed, e.g. there is no zstd)
+# blobs/ never changes between runs, so this only does real work the first time
+def compress_cached(src: str, codec: str) -> str | None:
+    compress, level = COMPRESSORS[codec]
+    artifact = os.path.join(cache_dir("compressed"), f"{sha256_file(src)}.{codec}{level}")
+    if not path_exists(artifact):
+        compress(src, artifact, level)
+    if not path_exists(artifact):
+        return None
+    return artifact
 
 
 #######################################################################################
@@ -114,49 +757,1101 @@ def print_question(message: str) -> None:
 def print_header(message: str) -> None:
     print("\033[95m" + message + "\033[0m", flush=True)
 
+#######################################################################################
+#                                   HARDWARE PROBE                                    #
+#######################################################################################
+# Everything the script needs to know about the host is read once into a HostSnapshot.
+# Every step reads from the snapshot instead of going back to sysfs/procfs, and a snapshot
+# can be saved to json on one machine and replayed on another (--save-snapshot/--snapshot).
+DMI_FIELDS = ("sys_vendor", "product_family", "product_name", "board_name")
+
+
+@dataclass(frozen=True)
+class HostSnapshot:
+    dmi: dict
+    pci_id: str
+    acpi_devices: frozenset
+    os_release: dict
+    os_release_raw: str
+    kernel_release: str
+    has_dmi: bool
+    has_cros_ec: bool
+
+    def __post_init__(self):
+        # freeze the containers too, so no step can modify the snapshot behind another one's back
+        object.__setattr__(self, "dmi", MappingProxyType(dict(self.dmi)))
+        object.__setattr__(self, "os_release", MappingProxyType(dict(self.os_release)))
+        object.__setattr__(self, "acpi_devices", frozenset(self.acpi_devices))
+
+    def to_dict(self) -> dict:
+        return {
+            "dmi": dict(self.dmi),
+            "pci_id": self.pci_id,
+            "acpi_devices": sorted(self.acpi_devices),
+            "os_release": dict(self.os_release),
+            "os_release_raw": self.os_release_raw,
+            "kernel_release": self.kernel_release,
+            "has_dmi": self.has_dmi,
+            "has_cros_ec": self.has_cros_ec,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HostSnapshot":
+        return cls(dmi=data.get("dmi", {}), pci_id=data.get("pci_id", ""),
+                   acpi_devices=data.get("acpi_devices", []), os_release=data.get("os_release", {}),
+                   os_release_raw=data.get("os_release_raw", ""), kernel_release=data.get("kernel_release", ""),
+                   has_dmi=data.get("has_dmi", True), has_cros_ec=data.get("has_cros_ec", False))
+
+
+# read a small sysfs/procfs file, returning an empty string if it doesn't exist
+def read_host_file(path: str) -> str:
+    try:
+        with open(path) as file:
+            return file.read().strip()
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return ""
+
+
+# parse os-release into a dict (KEY=value, values optionally quoted)
+def parse_os_release(text: str) -> dict:
+    release = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        key, value = line.split("=", 1)
+        release[key] = value.strip().strip("\"'")
+    return release
+
+
+# the running kernel, or the newest installed one when setting up another root
+def current_kernel_release() -> str:
+    return os.uname().release if root == "/" else next(iter(installed_kernels()), "")
+
+
+def probe_host() -> HostSnapshot:
+    dmi = {field: read_host_file(host_path(f"/sys/class/dmi/id/{field}")) for field in DMI_FIELDS}
+    try:
+        with os.scandir(host_path("/sys/bus/acpi/devices")) as entries:
+            acpi_devices = [entry.name for entry in entries]
+    except FileNotFoundError:
+        acpi_devices = []
+    os_release_raw = read_host_file(host_path("/etc/os-release"))
+    return HostSnapshot(dmi=dmi,
+                        pci_id=read_host_file(host_path("/sys/bus/pci/devices/0000:00:00.0/device")),
+                        acpi_devices=acpi_devices,
+                        os_release=parse_os_release(os_release_raw),
+                        os_release_raw=os_release_raw,
+                        kernel_release=current_kernel_release(),
+                        has_dmi=path_exists(host_path("/sys/devices/virtual/dmi/id/")),
+                        has_cros_ec=path_exists(host_path("/dev/cros_ec")))
+
+
+_snapshot = None
+
+
+# return the snapshot for this run, probing the host the first time it is needed
+def get_snapshot() -> HostSnapshot:
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = probe_host()
+    return _snapshot
+
+
+def set_snapshot(snapshot: HostSnapshot) -> None:
+    global _snapshot
+    _snapshot = snapshot
+
+
+def save_snapshot(path: str) -> None:
+    with open(path, "w") as file:
+        json.dump(get_snapshot().to_dict(), file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def load_snapshot(path: str) -> HostSnapshot:
+    try:
+        with open(path) as file:
+            snapshot = HostSnapshot.from_dict(json.load(file))
+    except (OSError, ValueError) as e:
+        print_error(f"Unable to load hardware snapshot {path}: {e}")
+        exit(1)
+    set_snapshot(snapshot)
+    return snapshot
+
+#######################################################################################
+#                                   BOARD DATABASE                                    #
+#######################################################################################
+# Everything the script knows about boards lives in boards.json:
+#   platforms: platform -> name, actions (see PLATFORM_ACTIONS), kconfig symbols, ucm directory names,
+#     optionally an audio profile
+#   audio_profiles: name -> alsa headroom (see AUDIO PROFILES)
+#   families/products/pci_ids: product_family, product_name (boards without a product_family)
+#     and pci 00:00.0 id -> platform, optionally with a more specific name
+#   codecs: ACPI HID -> codec name and kconfig symbols, optionally an audio profile
+#   kconfig_modules: kconfig symbol -> module(s) it builds, any one of them is enough
+# It is loaded and validated the first time it's needed; every lookup is a dict lookup.
+BOARD_DB = "boards.json"
+BOARD_DB_SECTIONS = ("actions", "platforms", "audio_profiles", "families", "products", "pci_ids", "codecs",
+                     "kconfig_modules")
+
+
+def is_str_list(value) -> bool:
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+# return a list of problems with the database, empty if it's valid
+def validate_board_db(db: dict) -> list:
+    errors = []
+    for section in BOARD_DB_SECTIONS:
+        if not isinstance(db.get(section), dict):
+            errors.append(f"missing section '{section}'")
+    if errors:
+        return errors
+    for action, description in db["actions"].items():
+        if action not in PLATFORM_ACTIONS:
+            errors.append(f"actions: unknown action '{action}'")
+        if not isinstance(description, str):
+            errors.append(f"actions.{action}: description must be a string")
+    for platform, entry in db["platforms"].items():
+        if not isinstance(entry.get("name"), str):
+            errors.append(f"platforms.{platform}: missing name")
+        for field in ("actions", "kconfig", "ucm_names"):
+            if not is_str_list(entry.get(field)):
+                errors.append(f"platforms.{platform}: {field} must be a list of strings")
+        for action in entry.get("actions", []):
+            if action not in db["actions"]:
+                errors.append(f"platforms.{platform}: unknown action '{action}'")
+        if "audio_profile" in entry and entry["audio_profile"] not in db["audio_profiles"]:
+            errors.append(f"platforms.{platform}: unknown audio profile '{entry['audio_profile']}'")
+    if DEFAULT_AUDIO_PROFILE not in db["audio_profiles"]:
+        errors.append(f"audio_profiles: missing the '{DEFAULT_AUDIO_PROFILE}' fallback profile")
+    for name, profile in db["audio_profiles"].items():
+        if not isinstance(profile.get("headroom"), int):
+            errors.append(f"audio_profiles.{name}: missing headroom")
+        for key, value in profile.items():
+            if key not in AUDIO_PROFILE_KEYS:
+                errors.append(f"audio_profiles.{name}: unknown setting '{key}'")
+            elif not isinstance(value, int) or value < 0:
+                errors.append(f"audio_profiles.{name}: {key} must be a positive number")
+    for section in ("families", "products", "pci_ids"):
+        for key, entry in db[section].items():
+            if entry.get("platform") not in db["platforms"]:
+                errors.append(f"{section}.{key}: unknown platform '{entry.get('platform')}'")
+            if "name" in entry and not isinstance(entry["name"], str):
+                errors.append(f"{section}.{key}: name must be a string")
+    names = set()
+    for hid, entry in db["codecs"].items():
+        if not isinstance(entry.get("name"), str) or not is_str_list(entry.get("kconfig")):
+            errors.append(f"codecs.{hid}: needs a name and a list of kconfig symbols")
+        elif entry["name"] in names:
+            errors.append(f"codecs.{hid}: duplicate codec name '{entry['name']}'")
+        if "audio_profile" in entry and entry["audio_profile"] not in db["audio_profiles"]:
+            errors.append(f"codecs.{hid}: unknown audio profile '{entry['audio_profile']}'")
+        names.add(entry.get("name"))
+    for symbol, modules in db["kconfig_modules"].items():
+        if not is_str_list(modules) or not modules:
+            errors.append(f"kconfig_modules.{symbol}: must be a non-empty list of module names")
+    return errors
+
+
+@functools.lru_cache(maxsize=None)
+def board_db() -> dict:
+    try:
+        with open(BOARD_DB) as file:
+            db = json.load(file)
+    except (OSError, ValueError) as e:
+        print_error(f"Unable to load board database {BOARD_DB}: {e}")
+        exit(1)
+    errors = validate_board_db(db)
+    if errors:
+        for error in errors:
+            print_error(f"{BOARD_DB}: {error}")
+        exit(1)
+    # reverse index, codec name -> entry
+    db["codec_names"] = {entry["name"]: entry for entry in db["codecs"].values()}
+    return db
+
+
+# ACPI HID -> codec name, built once like board_db()
+@functools.lru_cache(maxsize=None)
+def codec_table() -> dict:
+    return {hid: entry["name"] for hid, entry in board_db()["codecs"].items()}
+
+
+def platform_ucm_names(platform: str) -> list:
+    return board_db()["platforms"].get(platform, {}).get("ucm_names", [])
+
+
+# find a board by product_family (with or without google_), product_name or pci id
+# returns the database section and key it was found under
+def lookup_board(name: str):
+    db = board_db()
+    name = name.lower()
+    for section, key in (("families", name), ("families", f"google_{name}"), ("products", name), ("pci_ids", name)):
+        if key in db[section]:
+            return section, key
+    return None
+
+
+def find_board(name: str):
+    found = lookup_board(name)
+    if found is None:
+        return None
+    section, key = found
+    return board_db()[section][key]
+
+
+# ACPI HIDs of codecs given by name (rt5682) or HID (10EC5682), None for unknown codecs
+def codec_hids(codecs: list) -> list:
+    hids = []
+    for codec in codecs:
+        for hid, name in codec_table().items():
+            if codec.lower() in (hid.lower(), name.lower()):
+                hids.append(hid)
+                break
+        else:
+            return None
+    return hids
+
+
+# a snapshot of a board from the database instead of real hardware, used to set up images
+# for a known board. The distro and kernel still come from the (possibly redirected) root
+def profile_snapshot(board: str, codecs=None) -> HostSnapshot:
+    found = lookup_board(board)
+    if found is None:
+        print_error(f"Unknown board: {board}")
+        exit(1)
+    hids = codec_hids(codecs or [])
+    if hids is None:
+        print_error(f"Unknown codec in: {', '.join(codecs)}")
+        exit(1)
+    section, key = found
+    os_release_raw = read_host_file(host_path("/etc/os-release"))
+    return HostSnapshot(dmi={"sys_vendor": "Google",
+                             "product_family": key if section == "families" else "",
+                             "product_name": key if section == "products" else board.lower(),
+                             "board_name": board.lower()},
+                        pci_id=key if section == "pci_ids" else "",
+                        acpi_devices=[f"{hid}:00" for hid in hids],
+                        os_release=parse_os_release(os_release_raw),
+                        os_release_raw=os_release_raw,
+                        kernel_release=current_kernel_release(),
+                        has_dmi=True,
+                        has_cros_ec=True)
+
+
+# what the script would do on a board, without looking at the host
+def describe_board(name: str, codecs=None) -> dict:
+    db = board_db()
+    board = find_board(name)
+    if board is None:
+        return None
+    platform = board["platform"]
+    entry = db["platforms"][platform]
+    codecs = codecs or []
+    return {
+        "board": name,
+        "platform": platform,
+        "name": board.get("name", entry["name"]),
+        "actions": {action: db["actions"][action] for action in entry["actions"]},
+        "topology_links": [alias for tplg, alias in sum(TPLG_ALIASES.get(platform, {}).values(), [])],
+        "kconfig": kernel_symbols(platform, codecs),
+        "codecs": codecs,
+        "audio_profile": audio_profile(platform, codecs)[0],
+    }
+
+#######################################################################################
+#                                     UCM CACHE                                       #
+#######################################################################################
+# The UCM repo is kept in a persistent cache keyed by branch and commit, so re-runs don't
+# need to clone it again (or have network access at all).
+# Layout: <cache>/ucm/<branch>/<commit or bundle-hash>/{ucm2,overrides}
+UCM_REPO = "https://github.com/WeirdTreeThing/alsa-ucm-conf-cros"
+UCM_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # seconds
+UCM_CACHE_MAX_SIZE = 256 * 1024 * 1024  # bytes
+# how long to wait for the remote before falling back to the cache, a network that drops packets
+# would otherwise block until the TCP timeout
+UCM_REMOTE_TIMEOUT = 20  # seconds
+
+
+cache_base = None
+
+
+# use a different cache directory, e.g. one shared between image builds
+def set_cache_base(path: str) -> None:
+    global cache_base
+    cache_base = os.path.abspath(path)
+
+
+# persistent cache directory, per user when not running as root
+def cache_root() -> str:
+    if cache_base is not None:
+        return cache_base
+    if os.geteuid() == 0:
+        return "/var/cache/chromebook-linux-audio"
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "chromebook-linux-audio")
+
+
+def cache_dir(name: str) -> str:
+    path = os.path.join(cache_root(), name)
+    mkdir(path, create_parents=True)
+    return path
+
+
+def ucm_branch_cache(branch: str) -> str:
+    return cache_dir(os.path.join("ucm", branch.replace("/", "_")))
+
+
+# commit the remote (url, mirror or git bundle) currently has for a branch, or None if unreachable
+def ucm_remote_commit(remote: str, branch: str):
+    output = run(["git", "ls-remote", remote, branch], timeout=UCM_REMOTE_TIMEOUT)
+    if not output:
+        return None
+    return output.split()[0]
+
+
+# newest cached tree for a branch, used when the remote can't be reached
+def newest_cached_ucm(branch: str):
+    branch_dir = ucm_branch_cache(branch)
+    entries = [entry for entry in os.scandir(branch_dir)
+               if entry.is_dir() and not entry.name.startswith(".") and path_exists(f"{entry.path}/ucm2")]
+    if not entries:
+        return None
+    return max(entries, key=lambda entry: entry.stat().st_mtime).path
+
+
+# move a freshly populated temp dir into its final place in the cache
+# another run may have populated the same key concurrently, in which case theirs is used
+def commit_cache_entry(tmp_dir: str, dest: str) -> str:
+    try:
+        os.rename(tmp_dir, dest)
+    except OSError:
+        rmdir(tmp_dir, keep_dir=False)
+    return dest
+
+
+def ucm_clone(remote: str, branch: str) -> str:
+    branch_dir = ucm_branch_cache(branch)
+    tmp_dir = f"{branch_dir}/.tmp-{os.getpid()}"
+    rmdir(tmp_dir, keep_dir=False)
+    run(["git", "clone", "--depth", "1", remote, "-b", branch, tmp_dir])
+    if not path_exists(f"{tmp_dir}/ucm2"):
+        rmdir(tmp_dir, keep_dir=False)
+        return None
+    commit = git_head(tmp_dir)
+    rmdir(f"{tmp_dir}/.git", keep_dir=False)
+    return commit_cache_entry(tmp_dir, f"{branch_dir}/{commit}")
+
+
+# resolve HEAD of a checkout without running git
+def git_head(repo: str) -> str:
+    head = read_host_file(f"{repo}/.git/HEAD")
+    if not head.startswith("ref: "):
+        return head
+    ref = head[5:]
+    commit = read_host_file(f"{repo}/.git/{ref}")
+    if commit:
+        return commit
+    for line in read_host_file(f"{repo}/.git/packed-refs").splitlines():
+        if line.endswith(f" {ref}"):
+            return line.split()[0]
+    return "unknown"
+
+
+# unpack a tarball of the UCM repo (e.g. a github archive) into the cache, keyed by its hash
+def ucm_from_tarball(branch: str, tarball: str) -> str:
+    branch_dir = ucm_branch_cache(branch)
+    dest = f"{branch_dir}/bundle-{sha256_file(tarball)[:16]}"
+    if path_exists(dest):
+        return dest
+    tmp_dir = f"{branch_dir}/.tmp-{os.getpid()}"
+    rmdir(tmp_dir, keep_dir=False)
+    with tarfile.open(tarball) as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(tmp_dir, filter="data")
+        else:
+            tar.extractall(tmp_dir)
+    # archives usually have a single top level directory
+    top = tmp_dir
+    if not path_exists(f"{top}/ucm2"):
+        subdirs = [entry.path for entry in os.scandir(tmp_dir) if entry.is_dir()]
+        if len(subdirs) == 1 and path_exists(f"{subdirs[0]}/ucm2"):
+            top = subdirs[0]
+        else:
+            rmdir(tmp_dir, keep_dir=False)
+            print_error(f"Error: {tarball} does not contain a UCM tree")
+            exit(1)
+    if top != tmp_dir:
+        os.rename(top, f"{branch_dir}/.tmp-{os.getpid()}-tree")
+        rmdir(tmp_dir, keep_dir=False)
+        tmp_dir = f"{branch_dir}/.tmp-{os.getpid()}-tree"
+    rmdir(f"{tmp_dir}/.git", keep_dir=False)
+    return commit_cache_entry(tmp_dir, dest)
+
+
+# return a directory containing ucm2/ and overrides/ for the requested branch
+# source may be a checked out tree, a git mirror, a git bundle or a tarball
+def fetch_ucm(branch: str, source=None) -> str:
+    remote = UCM_REPO
+    if source:
+        if not path_exists(source):
+            print_error(f"Error: UCM source {source} does not exist")
+            exit(1)
+        if Path(source).is_dir() and path_exists(f"{source}/ucm2"):
+            print_status(f"Using UCM from {source}")
+            return source
+        if Path(source).is_file() and tarfile.is_tarfile(source):
+            print_status(f"Using UCM bundle {source}")
+            ucm_dir = ucm_from_tarball(branch, source)
+            prune_ucm_cache()
+            return ucm_dir
+        remote = source
+
+    ucm_dir = None
+    commit = ucm_remote_commit(remote, branch)
+    if commit:
+        cached = f"{ucm_branch_cache(branch)}/{commit}"
+        if path_exists(f"{cached}/ucm2"):
+            print_status(f"Using cached UCM ({branch} @ {commit[:12]})")
+            ucm_dir = cached
+        else:
+            ucm_dir = ucm_clone(remote, branch)
+    if not ucm_dir:
+        ucm_dir = newest_cached_ucm(branch)
+        if not ucm_dir:
+            print_error("Error: Failed to clone UCM repo")
+            exit(1)
+        print_warning(f"Unable to reach {remote}, using cached UCM from {ucm_dir}")
+    # mark as recently used so pruning keeps it
+    os.utime(ucm_dir)
+    prune_ucm_cache()
+    return ucm_dir
+
+
+def dir_size(path: str) -> int:
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(OSError):
+                size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+# drop cache entries that are too old or push the cache over its size limit, oldest first
+# the newest entry of every branch is always kept so offline re-runs keep working
+def prune_ucm_cache(max_age: int = UCM_CACHE_MAX_AGE, max_size: int = UCM_CACHE_MAX_SIZE) -> None:
+    ucm_cache = cache_dir("ucm")
+    now = time.time()
+    keep = set()
+    entries = []
+    for branch in os.scandir(ucm_cache):
+        if not branch.is_dir():
+            continue
+        branch_entries = [(entry.stat().st_mtime, entry.path) for entry in os.scandir(branch.path)
+                          if entry.is_dir() and not entry.name.startswith(".")]
+        if branch_entries:
+            keep.add(max(branch_entries)[1])
+        entries += branch_entries
+
+    total = 0
+    sizes = {}
+    for mtime, path in entries:
+        sizes[path] = dir_size(path)
+        total += sizes[path]
+    for mtime, path in sorted(entries):
+        if path in keep:
+            continue
+        if now - mtime > max_age or total > max_size:
+            rmdir(path, keep_dir=False)
+            total -= sizes[path]
+
+#######################################################################################
+#                                     UCM INDEX                                       #
+#######################################################################################
+# Only the part of the UCM tree a device actually uses needs to be installed.
+# Card (conf.d/, overrides/) and codec (codecs/) directories are picked by the codecs they
+# are named after, platform directories by the platform, and everything they reference
+# through Include/File "..." or <...> is pulled in as well. All other directories are
+# shared and always installed.
+UCM_CARD_DIRS = ("conf.d", "codecs")
+UCM_PLATFORM_DIRS = ("platforms",)
+UCM_REFERENCE = re.compile(r'File\s+"([^"]+)"|<([^<>:\s]+)>')
+MODEL_NUMBER = re.compile(r"\d{4,}")
+
+
+# names a card/codec directory may use for a codec: the codec name and its model number
+def codec_identifiers(codecs) -> set:
+    identifiers = set()
+    for codec in codecs:
+        if " " in codec:
+            continue
+        identifiers.add(codec)
+        identifiers.update(MODEL_NUMBER.findall(codec))
+    return identifiers
+
+
+# map every file in a UCM tree to the files it references (both relative to the tree root)
+def build_ucm_index(ucm_root: str) -> dict:
+    index = {}
+    for root, dirs, files in os.walk(ucm_root):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, ucm_root)
+            refs = set()
+            if os.path.islink(path):
+                target = os.path.normpath(os.path.join(os.path.dirname(rel_path), os.readlink(path)))
+                if not target.startswith(".."):
+                    refs.add(target)
+            elif name.endswith(".conf"):
+                with open(path, errors="replace") as file:
+                    for match in UCM_REFERENCE.finditer(file.read()):
+                        ref = match.group(1) or match.group(2)
+                        # references built from variables can't be resolved statically
+                        if "${" in ref:
+                            continue
+                        if ref.startswith("/"):
+                            refs.add(os.path.normpath(ref.lstrip("/")))
+                        else:
+                            refs.add(os.path.normpath(os.path.join(os.path.dirname(rel_path), ref)))
+                            refs.add(os.path.normpath(ref))
+            index[rel_path] = refs
+    return index
+
+
+# files an index entry pulls in, following references transitively
+def ucm_closure(index: dict, seeds) -> set:
+    selected = set()
+    pending = list(seeds)
+    while pending:
+        rel_path = pending.pop()
+        if rel_path in selected or rel_path not in index:
+            continue
+        selected.add(rel_path)
+        pending += index[rel_path]
+    return selected
+
+
+# card/codec directories are named after the codecs they drive (sof-rt5682, avs_max98357a,
+# acp3xalc5682m98, codecs/rt1019, ...), so compare both codec names and model numbers.
+# Directories that don't name any codec we know about (sof-hda-dsp, hdmi, bytcr-rt5640, ...)
+# are always wanted.
+def ucm_entry_wanted(name: str, platform: str, wanted: set, known: set) -> bool:
+    name = name.lower()
+    if not any(identifier in name for identifier in known):
+        return True
+    if any(identifier in name for identifier in wanted):
+        return True
+    tokens = set(re.split(r"[^a-z0-9]+", name))
+    return bool(tokens & set(platform_ucm_names(platform)))
+
+
+def select_from_index(index: dict, platform: str, codecs: list, card_dirs=UCM_CARD_DIRS) -> set:
+    wanted = codec_identifiers(codecs)
+    known = codec_identifiers(codec_table().values())
+    platform_names = set(platform_ucm_names(platform))
+
+    seeds = set()
+    platform_entries = {}
+    for rel_path in index:
+        parts = rel_path.split(os.sep)
+        if len(parts) > 2 and parts[0] in card_dirs:
+            if ucm_entry_wanted(parts[1], platform, wanted, known):
+                seeds.add(rel_path)
+        elif "" in card_dirs and len(parts) > 1:
+            if ucm_entry_wanted(parts[0], platform, wanted, known):
+                seeds.add(rel_path)
+        elif len(parts) > 2 and parts[0] in UCM_PLATFORM_DIRS:
+            platform_entries.setdefault(parts[1], []).append(rel_path)
+        else:
+            seeds.add(rel_path)
+    # unknown platform directory naming, install them all rather than risk missing one
+    matching = [name for name in platform_entries if name.lower() in platform_names]
+    for name in matching or platform_entries:
+        seeds.update(platform_entries[name])
+    return seeds
+
+
+# pick the UCM files needed for a platform and its codecs
+# returns (files relative to ucm2/, files relative to overrides/)
+def select_ucm_files(ucm_dir: str, platform: str, codecs: list):
+    ucm2_index = build_ucm_index(f"{ucm_dir}/ucm2")
+    ucm2_files = ucm_closure(ucm2_index, select_from_index(ucm2_index, platform, codecs))
+
+    override_files = set()
+    if path_exists(f"{ucm_dir}/overrides"):
+        override_index = build_ucm_index(f"{ucm_dir}/overrides")
+        # overrides are card directories installed into conf.d, but reference files in ucm2/
+        override_files = select_from_index(override_index, platform, codecs, card_dirs=("",))
+        refs = set()
+        for rel_path in override_files:
+            refs.update(override_index[rel_path])
+            refs.update(os.path.normpath(os.path.join("conf.d", ref)) for ref in override_index[rel_path])
+        ucm2_files |= ucm_closure(ucm2_index, refs)
+    return sorted(ucm2_files), sorted(override_files)
+
 #######################################################################################
 #                             PACKAGE MANAGER FUNCTIONS                               #
 #######################################################################################
+# Packages requested during a run are queued and installed at the end in a single transaction,
+# after one query of the local package database for which of them are already installed.
+# The distro is detected once, from the snapshot's os-release.
+
+# distro family -> names in os-release ID/ID_LIKE
+PACKAGE_FAMILIES = {
+    "arch": ("arch",),
+    "void": ("void",),
+    "debian": ("ubuntu", "debian"),
+    "suse": ("suse",),
+    "fedora": ("fedora",),
+    "alpine": ("alpine",),
+}
+
+
+# packages (one per line) of the given ones that a query command lists as installed
+def query_installed(args: list, packages: list) -> set:
+    return set((run(args + packages, check=False, quiet=True) or "").splitlines()) & set(packages)
+
+
+def dpkg_installed(packages: list) -> set:
+    output = run(["dpkg-query", "-W", "-f=${Package} ${db:Status-Abbrev}\n"] + packages, check=False, quiet=True)
+    return {line.split()[0] for line in (output or "").splitlines() if line.split()[1:2] == ["ii"]}
+
+
+def xbps_installed(packages: list) -> set:
+    # "ii name-version description"
+    output = run(["xbps-query", "-l"], check=False, quiet=True)
+    return {line.split()[1].rsplit("-", 1)[0] for line in (output or "").splitlines() if len(line.split()) > 1} & set(packages)
+
+
+# distro family -> (installed packages among the given ones, install command)
+PACKAGE_MANAGERS = {
+    "arch": (lambda packages: query_installed(["pacman", "-Qq"], packages), ["pacman", "-S", "--noconfirm", "--needed"]),
+    "void": (xbps_installed, ["xbps-install", "-y"]),
+    "debian": (dpkg_installed, ["apt-get", "install", "-y"]),
+    "suse": (lambda packages: query_installed(["rpm", "-q", "--qf", "%{NAME}\n"], packages),
+             ["zypper", "--non-interactive", "install"]),
+    "fedora": (lambda packages: query_installed(["rpm", "-q", "--qf", "%{NAME}\n"], packages), ["dnf", "install", "-y"]),
+    "alpine": (lambda packages: query_installed(["apk", "info", "-e"], packages), ["apk", "add", "--no-interactive"]),
+}
+
+package_queue = []
+package_queue_lock = Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def package_family():
+    release = get_snapshot().os_release
+    ids = f"{release.get('ID', '')} {release.get('ID_LIKE', '')}".lower()
+    for family, names in PACKAGE_FAMILIES.items():
+        if any(name in ids for name in names):
+            return family
+    return None
+
+
+# queue a package to be installed at the end of the run
 def install_package(arch_package: str = "", deb_package: str = "", rpm_package: str = "", suse_package: str = "",
                     void_package: str = "", alpine_package: str = ""):
-    with open("/etc/os-release", "r") as file:
-        distro = file.read()
-    if distro.lower().__contains__("arch"):
-        bash(f"pacman -S --noconfirm --needed {arch_package}")
-    elif distro.lower().__contains__("void"):
-        bash(f"xbps-install -y {void_package}")
-    elif distro.lower().__contains__("ubuntu") or distro.lower().__contains__("debian"):
-        bash(f"apt-get install -y {deb_package}")
-    elif distro.lower().__contains__("suse"):
-        bash(f"zypper --non-interactive install {suse_package}")
-    elif distro.lower().__contains__("fedora"):
-        bash(f"dnf install -y {rpm_package}")
-    elif distro.lower().__contains__("alpine"):
-        bash(f"apk add --no-interactive {alpine_package}")
-    else:
-        print_error(f"Unknown package manager! Please install {arch_package} using your package manager.")
+    names = {"arch": arch_package, "debian": deb_package, "fedora": rpm_package, "suse": suse_package,
+             "void": void_package, "alpine": alpine_package}
+    with package_queue_lock:
+        if names not in package_queue:
+            package_queue.append(names)
+
+
+# install=False only lists the missing packages, for the hooks that run while the package manager holds its lock
+def install_queued_packages(install: bool = True) -> None:
+    with package_queue_lock:
+        queued = list(package_queue)
+        package_queue.clear()
+    if not queued:
+        return
+    family = package_family()
+    if family is None:
+        print_error(f"Unknown package manager! Please install {', '.join(names['arch'] for names in queued)} "
+                    "using your package manager.")
+        return
+    packages = [names[family] for names in queued if names[family]]
+    if root != "/":
+        # the package database of this system says nothing about the image
+        print_error(f"Please install {', '.join(packages)} in {root}")
+        return
+    query, install = PACKAGE_MANAGERS[family]
+    installed = query(packages)
+    missing = [package for package in packages if package not in installed]
+    if not missing:
+        return
+    if not install:
+        print_warning(f"Not installing {', '.join(missing)} during a package transaction, please install them "
+                      "with your package manager")
+        return
+    print_header(f"Installing {', '.join(missing)}")
+    # stderr goes to the step's output instead of straight to the terminal
+    if run(install + missing, capture_stderr=True) is None:
+        print_error(f"Unable to install {', '.join(missing)}, please install them with your package manager")
+
+#######################################################################################
+#                                 TOPOLOGY SYMLINKS                                   #
+#######################################################################################
+# Topology aliases, per platform and firmware directory: (existing name, alias name).
+# Each directory is listed once and the whole alias set is planned against that listing,
+# so only links that are missing or point somewhere else get (re)created.
+TPLG_SUFFIXES = (".tplg", ".tplg.xz", ".tplg.zst")
+# RPL devices load tplg with a different file name than ADL, despite being the exact same file as their ADL counterparts
+# sof-bin currently doesn't include these symlinks, so we create them ourselves
+RPL_TPLGS = ["cs35l41", "max98357a-rt5682-4ch", "max98357a-rt5682", "max98360a-cs42l42", "max98360a-da7219", "max98360a-nau8825", "max98360a-rt5682-2way", "max98360a-rt5682-4ch", "max98360a-rt5682", "max98373-nau8825", "max98390-rt5682", "max98390-ssp2-rt5682-ssp0", "nau8825", "rt1019-nau8825", "rt1019-rt5682", "rt5682", "rt711", "sdw-max98373-rt5682"]
+TPLG_ALIASES = {
+    "adl": {
+        "/lib/firmware/intel/sof-tplg":
+            # sof-adl-max98360a-cs42l42.tplg is symlinked to sof-adl-max98360a-rt5682.tplg in ChromeOS
+            # (first, so the matching sof-rpl link can be planned in the same run)
+            [("sof-adl-max98360a-rt5682", "sof-adl-max98360a-cs42l42")]
+            + [(f"sof-adl-{tplg}", f"sof-rpl-{tplg}") for tplg in RPL_TPLGS],
+    },
+    # MTL/ACE doesn't need any aliases yet
+    "mtl": {
+        "/lib/firmware/intel/sof-ace-tplg": [],
+    },
+}
+
+
+# plan the links for one directory: a list of (link path, target, current target or None)
+def plan_tplg_links(directory: str, aliases: list) -> list:
+    try:
+        with os.scandir(host_path(directory)) as entries:
+            listing = {entry.name: entry.is_symlink() for entry in entries}
+    except FileNotFoundError:
+        return []
+
+    plan = []
+    for tplg, alias in aliases:
+        for suffix in TPLG_SUFFIXES:
+            if f"{tplg}{suffix}" not in listing:
+                continue
+            link = f"{directory}/{alias}{suffix}"
+            target = f"{directory}/{tplg}{suffix}"
+            current = None
+            if f"{alias}{suffix}" in listing:
+                if not listing[f"{alias}{suffix}"]:
+                    current = "(regular file)"
+                else:
+                    current = os.readlink(host_path(link))
+                    if current in (target, f"{tplg}{suffix}"):
+                        continue
+            plan.append((link, target, current))
+            # later aliases may point at this one
+            listing.setdefault(f"{alias}{suffix}", True)
+    return plan
+
+
+def plan_platform_tplg_links(platform: str) -> list:
+    plan = []
+    for directory, aliases in TPLG_ALIASES.get(platform, {}).items():
+        plan += plan_tplg_links(directory, aliases)
+    return plan
+
+
+# dry-run diff of a plan, + for new links and ~ for links that get replaced
+def format_tplg_plan(plan: list) -> str:
+    lines = []
+    for link, target, current in plan:
+        if current is None:
+            lines.append(f"+ {link} -> {target}")
+        else:
+            lines.append(f"~ {link} -> {target} (was {current})")
+    return "\n".join(lines)
+
+
+def apply_tplg_links(plan: list) -> None:
+    for link, target, current in plan:
+        symlink(target, host_path(link))
+
+
+def install_tplg_links(platform: str) -> None:
+    plan = plan_platform_tplg_links(platform)
+    apply_tplg_links(plan)
+    if plan:
+        print_status(f"Linked {len(plan)} topologies")
+
+#######################################################################################
+#                                   AUDIO PROFILES                                    #
+#######################################################################################
+# Raising the alsa headroom fixes instability on some platforms (AVS, Stoney Ridge, ...) but
+# adds latency everywhere. The platform and the codecs pick a profile from boards.json; when they
+# disagree the one with the most headroom wins, and anything without a profile gets the
+# conservative one (the headroom everything used to get).
+# The wireplumber fragment sets the headroom on the alsa output nodes.
+DEFAULT_AUDIO_PROFILE = "conservative"
+AUDIO_PROFILE_KEYS = ("headroom",)
+WIREPLUMBER_PROFILE = "/etc/wireplumber/wireplumber.conf.d/51-audio-profile.conf"
+# fragments older versions of the script installed
+OLD_PROFILE_FILES = ("/etc/wireplumber/wireplumber.conf.d/51-increase-headroom.conf",)
+
+
+# (name, settings) of the profile for a platform and its codecs
+def audio_profile(platform, codecs) -> tuple:
+    db = board_db()
+    names = [db["platforms"].get(platform, {}).get("audio_profile", DEFAULT_AUDIO_PROFILE)]
+    names += [db["codec_names"][codec]["audio_profile"] for codec in codecs
+              if "audio_profile" in db["codec_names"].get(codec, {})]
+    name = max(names, key=lambda name: db["audio_profiles"][name]["headroom"])
+    return name, db["audio_profiles"][name]
+
+
+def alsa_rule(node_name: str, props: str) -> str:
+    return (f"  {{\n    matches = [\n      {{\n        node.name = \"{node_name}\"\n      }}\n    ]\n"
+            f"    actions = {{\n      update-props = {{\n{props}      }}\n    }}\n  }}\n")
+
+
+def wireplumber_fragment(name: str, profile: dict, platform) -> str:
+    return (f"# Generated by chromebook-linux-audio: {name} profile for {platform}\n"
+            "monitor.alsa.rules = [\n"
+            + alsa_rule("~alsa_output.*", f"        api.alsa.headroom = {profile['headroom']}\n") + "]\n")
+
+
+def install_audio_profile(platform, codecs) -> None:
+    name, profile = audio_profile(platform, codecs)
+    print_header(f"Installing {name} audio profile (alsa headroom {profile['headroom']})")
+    for path in OLD_PROFILE_FILES:
+        rmfile(host_path(path))
+    if not path_exists(host_path("/usr/bin/wireplumber")):
+        rmfile(host_path(WIREPLUMBER_PROFILE))
+        return
+    mkdir(os.path.dirname(host_path(WIREPLUMBER_PROFILE)), create_parents=True)
+    sync_data(host_path(WIREPLUMBER_PROFILE), wireplumber_fragment(name, profile, platform).encode())
+
+#######################################################################################
+#                                   FIRMWARE BLOBS                                    #
+#######################################################################################
+# blobs/manifest.json has the size and sha256 of every blob shipped in blobs/ (regenerate it
+# with --update-manifest after changing them). Blobs are checked against it before they are
+# installed, and every installed copy, compressed ones included, is recorded with its size,
+# mtime and hash. --verify then needs a single stat per installed file: only files whose size or
+# mtime changed are hashed again, and the ones that don't match anymore are reinstalled.
+BLOB_DIR = "blobs"
+BLOB_MANIFEST = "blobs/manifest.json"
+BLOB_RECORD = "/var/lib/chromebook-linux-audio/firmware.json"
+
+# installed path (unrooted) -> blob, codec, size, mtime_ns, sha256
+installed_blobs = {}
+installed_blobs_lock = Lock()
+
+
+def generate_blob_manifest() -> dict:
+    manifest = {}
+    for dirpath, dirs, files in os.walk(BLOB_DIR):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            if path != BLOB_MANIFEST:
+                manifest[os.path.relpath(path, BLOB_DIR)] = {"size": os.path.getsize(path), "sha256": sha256_file(path)}
+    return manifest
+
+
+def write_blob_manifest() -> None:
+    with open(BLOB_MANIFEST, "w") as file:
+        json.dump(generate_blob_manifest(), file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+@functools.lru_cache(maxsize=None)
+def blob_manifest() -> dict:
+    try:
+        with open(BLOB_MANIFEST) as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        print_error(f"Unable to load blob manifest {BLOB_MANIFEST}: {e}")
+        exit(1)
+
+
+# make sure a blob is the one the manifest lists before installing it, returns its sha256
+@functools.lru_cache(maxsize=None)
+def check_blob(blob: str) -> str:
+    entry = blob_manifest().get(os.path.relpath(blob, BLOB_DIR))
+    if entry is None:
+        print_error(f"{blob} is not in {BLOB_MANIFEST}")
+        exit(1)
+    if os.path.getsize(blob) != entry["size"] or sha256_file(blob) != entry["sha256"]:
+        print_error(f"{blob} doesn't match {BLOB_MANIFEST}, the repo is corrupted. Please clone it again.")
+        exit(1)
+    return entry["sha256"]
+
+
+# remember that dest was installed from blob (compressed with codec, through the file src)
+def record_blob(blob: str, dest: str, codec, src: str) -> None:
+    dest_stat = os.stat(dest)
+    entry = {"blob": os.path.relpath(blob, BLOB_DIR), "codec": codec, "size": dest_stat.st_size,
+             "mtime_ns": dest_stat.st_mtime_ns, "sha256": check_blob(blob) if codec is None else sha256_file(src)}
+    with installed_blobs_lock:
+        installed_blobs[root_path(dest)] = entry
+
+
+def install_blob(blob: str, dest: str, codec=None) -> None:
+    check_blob(blob)
+    src = compress_cached(blob, codec) if codec else blob
+    cpfile(src, dest)
+    record_blob(blob, dest, codec, src)
+
+
+def load_blob_record() -> dict:
+    try:
+        with open(host_path(BLOB_RECORD)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print_error(f"Unable to load {host_path(BLOB_RECORD)}: {e}")
+        exit(1)
+
+
+# merge what this run installed into the record, without touching it if nothing changed
+def save_blob_record() -> None:
+    record = load_blob_record()
+    with installed_blobs_lock:
+        updated = {**record, **installed_blobs}
+    if updated == record:
+        return
+    mkdir(os.path.dirname(host_path(BLOB_RECORD)), create_parents=True)
+    write_file_atomic(host_path(BLOB_RECORD), (json.dumps(updated, indent=2, sort_keys=True) + "\n").encode())
+
+
+# check every recorded firmware file and reinstall the ones that changed, returns how many were
+def verify_blobs() -> int:
+    record = load_blob_record()
+    if not record:
+        print_error("No firmware installed by this script was found")
+        return 0
+    changed = []
+    for dest, entry in record.items():
+        try:
+            dest_stat = os.stat(host_path(dest))
+        except FileNotFoundError:
+            # compressed copies are only installed where the distro ships that format, if it
+            # doesn't anymore the copy isn't needed either
+            if entry["codec"] is None:
+                changed.append(dest)
+            continue
+        if dest_stat.st_size == entry["size"] and dest_stat.st_mtime_ns == entry["mtime_ns"]:
+            continue
+        if dest_stat.st_size == entry["size"] and sha256_file(host_path(dest)) == entry["sha256"]:
+            # only touched, remember the new mtime so the next check takes the fast path again
+            with installed_blobs_lock:
+                installed_blobs[dest] = {**entry, "mtime_ns": dest_stat.st_mtime_ns}
+            continue
+        changed.append(dest)
+    for dest in changed:
+        entry = record[dest]
+        print_status(f"Reinstalling {dest}")
+        mkdir(os.path.dirname(host_path(dest)), create_parents=True)
+        install_blob(os.path.join(BLOB_DIR, entry["blob"]), host_path(dest), entry["codec"])
+    print_status(f"Verified {len(record)} firmware files, reinstalled {len(changed)}")
+    return len(changed)
+
+#######################################################################################
+#                                      ANSWERS                                        #
+#######################################################################################
+# Every question the script may ask can be answered up front, from a json answer file
+# (--answers), CHROMEBOOK_AUDIO_<NAME> environment variables or --answer NAME=VALUE, in
+# increasing order of precedence. The answers a device needs are checked before anything is
+# changed; unattended runs fail at that point instead of asking later.
+# The max98357a acknowledgements still need the full sentence, a "yes" is not enough.
+
+MAX98357A_ACK = "I UNDERSTAND MY SPEAKERS WILL NOT WORK SINCE MY DEVICE HAS MAX98357A!"
+MAX98357A_RISK_ACK = "I UNDERSTAND THE RISK OF PERMANENTLY DAMAGING MY SPEAKERS"
+
+# answer name -> accepted answers
+ANSWER_CHOICES = {
+    "atom_driver": ("sst", "sof"),
+    "max98357a_ack": (MAX98357A_ACK,),
+    "max98357a_risk_ack": (MAX98357A_RISK_ACK,),
+}
+# choices that are matched case-insensitively, the acknowledgements have to be typed exactly
+CASE_INSENSITIVE_ANSWERS = ("atom_driver",)
+ANSWER_ENV_PREFIX = "CHROMEBOOK_AUDIO_"
+
+answers = {}
+unattended = False
+
+
+def normalize_answer(name: str, value):
+    if name in CASE_INSENSITIVE_ANSWERS and isinstance(value, str):
+        return value.lower()
+    return value
+
+
+# merge the answer file, the environment and NAME=VALUE overrides
+def load_answers(path=None, overrides=None) -> dict:
+    given = {}
+    if path:
+        try:
+            with open(path) as file:
+                given = json.load(file)
+        except (OSError, ValueError) as e:
+            print_error(f"Unable to load answer file {path}: {e}")
+            exit(1)
+        if not isinstance(given, dict):
+            print_error(f"{path}: expected a json object of answers")
+            exit(1)
+    for name in ANSWER_CHOICES:
+        value = os.environ.get(ANSWER_ENV_PREFIX + name.upper())
+        if value is not None:
+            given[name] = value
+    for override in overrides or []:
+        name, sep, value = override.partition("=")
+        if not sep:
+            print_error(f"Invalid answer {override}, expected NAME=VALUE")
+            exit(1)
+        given[name] = value
+    return {name: normalize_answer(name, value) for name, value in given.items()}
+
+
+def validate_answers(given: dict) -> list:
+    errors = []
+    for name, value in given.items():
+        if name not in ANSWER_CHOICES:
+            errors.append(f"unknown answer {name}, expected one of {', '.join(ANSWER_CHOICES)}")
+        elif normalize_answer(name, value) not in ANSWER_CHOICES[name]:
+            errors.append(f"invalid answer for {name}: {value!r}, expected one of {', '.join(ANSWER_CHOICES[name])}")
+    return errors
+
+
+# questions the platform config of this device is going to ask
+def needed_answers(platform, args) -> list:
+    actions = board_db()["platforms"].get(platform, {}).get("actions", [])
+    needed = []
+    if "sst_atom_config" in actions:
+        needed.append("atom_driver")
+    if "avs_config" in actions and "MX98357A:00" in get_snapshot().acpi_devices:
+        needed.append("max98357a_risk_ack" if args.force_avs_install else "max98357a_ack")
+    return needed
+
+
+def set_answers(given: dict, is_unattended: bool = False) -> None:
+    global answers, unattended
+    answers = {name: normalize_answer(name, value) for name, value in given.items()}
+    unattended = is_unattended
+
+
+# answer a question from the answers given up front, or ask
+def ask(name: str, prompt: str) -> str:
+    if name in answers:
+        print(f"{prompt}{answers[name]}")
+        return answers[name]
+    if unattended:
+        print_error(f"No answer for {name} given in unattended mode")
+        exit(1)
+    value = normalize_answer(name, input(prompt))
+    # remembered for --reconcile, which runs unattended with the answers of the last full run
+    if value in ANSWER_CHOICES[name]:
+        answers[name] = value
+    return value
 
 #######################################################################################
 #                          PLATFORM-SPECIFIC CONFIG FUNCTIONS                         #
 #######################################################################################
 def platform_config(platform, args):
-    match platform:
-        case "bdw" | "byt" | "bsw":
-            sst_atom_config()
-        case "skl" | "kbl" | "apl":
-            avs_config(args)
-        case "glk" | "cml" | "tgl" | "jsl":
-            check_sof_fw()
-        case "adl":
-            adl_sof_config()
-            check_sof_fw()
-        case "mtl":
-            mtl_sof_config()
-            check_sof_fw()
-        case "st":
-            st_warning()
-        case "mdn":
-            mdn_config()
+    for action in board_db()["platforms"].get(platform, {}).get("actions", []):
+        PLATFORM_ACTIONS[action](args)
 
 def get_platform():
     # first check if we are on a chromeb{ook,ox,ase,let} (either sys_vendor or product_family includes "google" (case-insensitive for old devices where it was GOOGLE))
@@ -165,105 +1860,50 @@ def get_platform():
     # for some reason, cyan also doesnt have this set even though every other bsw board does
     # samus and buddy are BDW but use intel SST
     print_header("Detecting platform")
-    platform = ""
-    sv = ""
-    pf = ""
-    pn = ""
-
-    with open("/sys/class/dmi/id/sys_vendor") as sys_vendor:
-        sv = sys_vendor.read().strip().lower()
-    with open("/sys/class/dmi/id/product_family") as product_family:
-        pf = product_family.read().strip().lower()
-    with open("/sys/class/dmi/id/product_name") as product_name:
-        pn = product_name.read().strip().lower()
+    snapshot = get_snapshot()
+    sv = snapshot.dmi["sys_vendor"].lower()
+    pf = snapshot.dmi["product_family"].lower()
+    pn = snapshot.dmi["product_name"].lower()
 
     # some people are morons
     if pn == "crosvm":
         print_error("This script can not and will not do anything in the crostini vm!")
         exit(1)
 
-    if not "google" in sv and not "google" in pf and not Path("/dev/cros_ec").exists():
+    if not "google" in sv and not "google" in pf and not snapshot.has_cros_ec:
         print_error("This script is not supported on non-Chrome devices!")
         exit(1)
 
-    if not len(pf) == 0:
-        match pf:
-            case "intel_strago":
-                print_status("Detected Intel Braswell")
-                platform = "bsw"
-            case "google_glados":
-                print_status("Detected Intel Skylake")
-                platform = "skl"
-            case "google_coral" | "google_reef":
-                print_status("Detected Intel Apollolake")
-                platform = "apl"
-            case "google_atlas" | "google_poppy" | "google_nami" | "google_nautilus" | "google_nocturne" | "google_rammus" | "google_soraka" | "google_eve" | "google_fizz" | "google_kalista" | "google_endeavour":
-                print_status("Detected Intel Kabylake")
-                platform = "kbl"
-            case "google_octopus":
-                print_status("Detected Intel Geminilake")
-                platform = "glk"
-            case "google_hatch" | "google_puff":
-                print_status("Detected Intel Cometlake")
-                platform = "cml"
-            case "google_dedede":
-                print_status("Detected Intel Jasperlake")
-                platform = "jsl"
-            case "google_volteer":
-                print_status("Detected Intel Tigerlake")
-                platform = "tgl"
-            case "google_brya" | "google_brask":
-                print_status("Detected Intel Alderlake")
-                platform = "adl"
-            case "google_nissa":
-                print_status("Detected Intel Alderlake-N")
-                platform = "adl"
-            case "google_rex":
-                print_status("Detected Intel Meteorlake")
-                platform = "mtl"
-            case "google_kahlee":
-                print_status("Detected AMD StoneyRidge")
-                platform = "st"
-            case "google_zork":
-                print_status("Detected AMD Picasso/Dali")
-                platform = "pco"
-            case "google_guybrush":
-                print_status("Detected AMD Cezanne")
-                platform = "czn"
-            case "google_skyrim":
-                print_status("Detected AMD Mendocino")
-                platform = "mdn"
-            case _:
-                print_error(f"Unknown platform/baseboard: {pf}")
-                exit(1)
-        return platform
-    else:
-        # Cyan special case
-        if pn == "cyan":
-            print_status("Detected Intel Braswell")
-            return "bsw"
-        # BDW special cases (every other BDW uses HDA audio)
-        if pn == "samus" or pn == "buddy":
-            print_status("Detected Intel Broadwell")
-            return "bdw"
-        id = ""
-        with open("/sys/bus/pci/devices/0000:00:00.0/device") as devid:
-            id = devid.read().strip()
-        # BYT special case - check if pci dev id is 0x0f00
-        if id == "0x0f00":
-            print_status("Detected Intel Baytrail")
-            return "byt"
-        # JSL special case - check if pci dev id is 0x4e22 or 0x4e12 or 0x4e26
-        if id == "0x4e22" or id == "0x4e12" or id == "0x4e26":
-            print_status("Detected Intel Jasperlake")
-            return "jsl"
+    board = match_board(snapshot)
+    if board is None:
+        if pf:
+            print_error(f"Unknown platform/baseboard: {pf}")
+            exit(1)
+        return None
+    platform = board["platform"]
+    print_status(f"Detected {board.get('name', board_db()['platforms'][platform]['name'])}")
+    return platform
+
+# the board database entry of a snapshot, without any checks or output
+def match_board(snapshot):
+    db = board_db()
+    pf = snapshot.dmi["product_family"].lower()
+    if pf:
+        return db["families"].get(pf)
+    # Cyan special case
+    # BDW special cases (every other BDW uses HDA audio)
+    board = db["products"].get(snapshot.dmi["product_name"].lower())
+    # BYT/JSL special cases - check the pci dev id
+    if board is None:
+        board = db["pci_ids"].get(snapshot.pci_id)
+    return board
 
 def mdn_config():
     print_header("Installing MDN SOF firmware")
-    mkdir("/lib/firmware/amd/sof/community", create_parents=True)
-    mkdir("/lib/firmware/amd/sof-tplg", create_parents=True)
-    cpdir("blobs/mdn/fw", "/lib/firmware/amd/sof/community")
-    cpdir("blobs/mdn/tplg", "/lib/firmware/amd/sof-tplg")
+    for blobs, dest in (("blobs/mdn/fw", "/lib/firmware/amd/sof/community"), ("blobs/mdn/tplg", "/lib/firmware/amd/sof-tplg")):
+        mkdir(host_path(dest), create_parents=True)
+        for name in sorted(os.listdir(blobs)):
+            install_blob(f"{blobs}/{name}", host_path(f"{dest}/{name}"))
 
 def st_warning():
     print_warning("WARNING: Audio on AMD StoneyRidge Chromebooks requires a patched kernel.")
@@ -274,12 +1914,12 @@ def st_warning():
 def avs_config(args):
     # Only show the warning to devices with max98357a
     override_avs = False
-    if path_exists("/sys/bus/acpi/devices/MX98357A:00"):
+    if "MX98357A:00" in get_snapshot().acpi_devices:
         if args.force_avs_install:
             print_error(
                 "WARNING: Your device has max98357a and can cause permanent damage to your speakers if you set the volume too loud!")
-            while input('Type "I understand the risk of permanently damaging my speakers" in all caps to continue: ')\
-                != "I UNDERSTAND THE RISK OF PERMANENTLY DAMAGING MY SPEAKERS":
+            while ask("max98357a_risk_ack", 'Type "I understand the risk of permanently damaging my speakers" in all caps to continue: ')\
+                != MAX98357A_RISK_ACK:
                 print_error("Try again")
             override_avs = True
         else:
@@ -289,264 +1929,750 @@ def avs_config(args):
                     "disabled until a fix is in place. Headphones and HDMI audio are safe from this.")
             print_question("If you want to disable this check, restart the script with --force-avs-install")
 
-            while input('Type "I Understand my speakers will not work since my device has max98357a!" in all caps to continue: ')\
-                != "I UNDERSTAND MY SPEAKERS WILL NOT WORK SINCE MY DEVICE HAS MAX98357A!":
+            while ask("max98357a_ack", 'Type "I Understand my speakers will not work since my device has max98357a!" in all caps to continue: ')\
+                != MAX98357A_ACK:
                 print_error("Try again")
             override_avs = False
 
     print_header("Enabling AVS driver")
-    cpfile("conf/avs/snd-avs.conf", "/etc/modprobe.d/snd-avs.conf")
+    cpfile("conf/avs/snd-avs.conf", host_path("/etc/modprobe.d/snd-avs.conf"))
 
     # Delete topology for max98357a to prevent it from working until there is a volume limiter.
     if not override_avs:
-        rmfile("/lib/firmware/intel/avs/max98357a-tplg.bin")
+        rmfile(host_path("/lib/firmware/intel/avs/max98357a-tplg.bin"))
 
 def check_sof_fw():
     # Certain devices (only HP?) set the system vendor to not Google on stock firmware, which breaks chromebook detection in the dspcfg driver. If this is the case, force the sof driver.
-    sv = ""
-    with open("/sys/class/dmi/id/sys_vendor") as sys_vendor:
-        sv = sys_vendor.read().strip().lower()
+    sv = get_snapshot().dmi["sys_vendor"].lower()
     if not sv == "google":
         print_header("Enabling SOF driver")
-        cpfile("conf/sof/snd-sof.conf", "/etc/modprobe.d/snd-sof.conf")
-
-    if not path_exists("/lib/firmware/intel/sof"):
-        print_error("SOF firmware is missing, audio will not work!")
-        print_error("Please install the SOF firmware package (usually sof-firmware) with your package manager")
+        cpfile("conf/sof/snd-sof.conf", host_path("/etc/modprobe.d/snd-sof.conf"))
 
-def symlink_tplg(path, tplg1, tplg2):
-    if path_exists(f"{path}/{tplg1}.tplg"):
-        bash(f"ln -sf {path}/{tplg1}.tplg {path}/{tplg2}.tplg")
-    if path_exists(f"{path}/{tplg1}.tplg.xz"):
-        bash(f"ln -sf {path}/{tplg1}.tplg.xz {path}/{tplg2}.tplg.xz")
-    if path_exists(f"{path}/{tplg1}.tplg.zst"):
-        bash(f"ln -sf {path}/{tplg1}.tplg.zst {path}/{tplg2}.tplg.zst")
+    if not path_exists(host_path("/lib/firmware/intel/sof")):
+        print_status("SOF firmware is missing, it will be installed at the end")
+        install_package(arch_package="sof-firmware", deb_package="firmware-sof-signed", rpm_package="alsa-sof-firmware",
+                        suse_package="sof-firmware", void_package="sof-firmware", alpine_package="sof-firmware")
 
 def install_downstream_tplg(tplg, dest):
-    if path_exists(f"{dest}"):
-        cpfile(f"{tplg}", f"{dest}")
-    if path_exists(f"{dest}.xz"):
-        bash(f"xz -c {tplg} > {dest}.xz")
-    if path_exists(f"{dest}.zst"):
-        bash(f"zstd {tplg} -o {dest}.zst")
+    install_downstream_tplgs([(tplg, dest)])
+
+# replace distro topologies with our own, in every compression format the distro ships them in
+def install_downstream_tplgs(tplgs):
+    jobs = {}
+    for tplg, dest in tplgs:
+        check_blob(tplg)
+        if path_exists(f"{dest}"):
+            install_blob(tplg, dest)
+        for codec in COMPRESSORS:
+            if path_exists(f"{dest}.{codec}"):
+                jobs.setdefault((tplg, codec), []).append(f"{dest}.{codec}")
+    # compress in parallel (both lzma and zstd release the GIL), or just pick up the cached copies
+    with ThreadPoolExecutor() as pool:
+        artifacts = pool.map(lambda job: compress_cached(*job), jobs)
+    for (tplg, codec), dests, artifact in zip(jobs, jobs.values(), artifacts):
+        if artifact is None:
+            print_warning(f"Could not compress {tplg} with {codec}, not replacing {', '.join(dests)}")
+            continue
+        for dest in dests:
+            cpfile(artifact, dest)
+            record_blob(tplg, dest, codec, artifact)
 
 def adl_sof_config():
-    # Special tplg cases
-    # RPL devices load tplg with a different file name than ADL, despite being the exact same file as their ADL counterparts
-    # sof-bin currently doesn't include these symlinks, so we create them ourselves
-    tplgs = ["cs35l41", "max98357a-rt5682-4ch", "max98357a-rt5682", "max98360a-cs42l42", "max98360a-da7219", "max98360a-nau8825", "max98360a-rt5682-2way", "max98360a-rt5682-4ch", "max98360a-rt5682", "max98373-nau8825", "max98390-rt5682", "max98390-ssp2-rt5682-ssp0", "nau8825", "rt1019-nau8825", "rt1019-rt5682", "rt5682", "rt711", "sdw-max98373-rt5682"]
-    for tplg in tplgs:
-        symlink_tplg("/lib/firmware/intel/sof-tplg", f"sof-adl-{tplg}", f"sof-rpl-{tplg}")
-    # sof-adl-max98360a-cs42l42.tplg is symlinked to sof-adl-max98360a-rt5682.tplg in ChromeOS
-    symlink_tplg("/lib/firmware/intel/sof-tplg", "sof-adl-max98360a-rt5682", "sof-adl-max98360a-cs42l42")
+    # Special tplg cases (see TPLG_ALIASES)
+    install_tplg_links("adl")
     # upstream sof-adl-rt1019-rt5682 is broken currently
-    install_downstream_tplg("blobs/adl/sof-adl-rt1019-rt5682.tplg", "/lib/firmware/intel/sof-tplg/sof-adl-rt1019-rt5682.tplg")
+    install_downstream_tplg("blobs/adl/sof-adl-rt1019-rt5682.tplg", host_path("/lib/firmware/intel/sof-tplg/sof-adl-rt1019-rt5682.tplg"))
 
 def mtl_sof_config():
     print_header("Enabling SOF driver")
-    cpfile("conf/sof/snd-sof.conf", "/etc/modprobe.d/snd-sof.conf")
+    cpfile("conf/sof/snd-sof.conf", host_path("/etc/modprobe.d/snd-sof.conf"))
     # upstream mtl tplgs are broken currently
-    install_downstream_tplg("blobs/mtl/sof-mtl-rt5650.tplg", "/lib/firmware/intel/sof-ace-tplg/sof-mtl-rt5650.tplg")
-    install_downstream_tplg("blobs/mtl/sof-mtl-rt1019-rt5682.tplg", "/lib/firmware/intel/sof-ace-tplg/sof-mtl-rt1019-rt5682.tplg")
+    install_downstream_tplgs([("blobs/mtl/sof-mtl-rt5650.tplg", host_path("/lib/firmware/intel/sof-ace-tplg/sof-mtl-rt5650.tplg")),
+                              ("blobs/mtl/sof-mtl-rt1019-rt5682.tplg", host_path("/lib/firmware/intel/sof-ace-tplg/sof-mtl-rt1019-rt5682.tplg"))])
 
 def sst_atom_config():
     print_status("There are two audio drivers available for your device: SST and SOF")
     print_status("Try SST first. If SST doesn't work, try SOF instead.")
 
     while True:
-        user_input = input("Which driver would you like to use? [sof/sst]: ")
-        if user_input.lower() == "sof":
+        user_input = ask("atom_driver", "Which driver would you like to use? [sof/sst]: ")
+        if user_input == "sof":
             print_status("Using sof")
             # Remove sst modprobe config if it exists
-            rmfile("/etc/modprobe.d/snd-sst.conf")
+            rmfile(host_path("/etc/modprobe.d/snd-sst.conf"))
             # Install sof modprobe config
-            cpfile("conf/sof/hifi2-sof.conf", "/etc/modprobe.d/hifi2-sof.conf")
+            cpfile("conf/sof/hifi2-sof.conf", host_path("/etc/modprobe.d/hifi2-sof.conf"))
             check_sof_fw()
             break
-        elif user_input.lower() == "sst":
+        elif user_input == "sst":
             print_status("Using sst")
             # Remove sof modprobe config if it exists
-            rmfile("/etc/modprobe.d/hifi2-sof.conf")
+            rmfile(host_path("/etc/modprobe.d/hifi2-sof.conf"))
             # Install sst modprobe config
-            cpfile("conf/common/snd-sst.conf", "/etc/modprobe.d/snd-sst.conf")
+            cpfile("conf/common/snd-sst.conf", host_path("/etc/modprobe.d/snd-sst.conf"))
             break
         else:
             print_error(f"Invalid option: {user_input}")
             continue
 
+# action names used in boards.json
+PLATFORM_ACTIONS = {
+    "sst_atom_config": lambda args: sst_atom_config(),
+    "avs_config": avs_config,
+    "check_sof_fw": lambda args: check_sof_fw(),
+    "adl_sof_config": lambda args: adl_sof_config(),
+    "mtl_sof_config": lambda args: mtl_sof_config(),
+    "st_warning": lambda args: st_warning(),
+    "mdn_config": lambda args: mdn_config(),
+}
+
+#######################################################################################
+#                                   STEP SCHEDULER                                    #
+#######################################################################################
+# setup-audio's work is declared as steps with explicit inputs (requires) and outputs
+# (provides). Steps whose inputs are ready run concurrently in a thread pool, and their
+# output is buffered and printed in declaration order so it reads like a sequential run.
+# Interactive steps (ones that may call input()) run on the main thread between the pool's
+# steps and print directly instead.
+@dataclass
+class Step:
+    name: str
+    func: object  # func(ctx) -> dict of outputs or None
+    requires: tuple = ()
+    provides: tuple = ()
+    interactive: bool = False
+
+
+# sys.stdout replacement that sends each worker thread's output to its step's buffer
+class StepOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is not None:
+            return buffer.write(text)
+        with self.lock:
+            return self.stream.write(text)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_step(step: Step, ctx: dict, output: StepOutput):
+    # interactive steps run on the main thread and print directly, nothing else prints while they run
+    buffer = None if step.interactive else io.StringIO()
+    output.local.buffer = buffer
+    try:
+        func = step.func if tracer is None else lambda ctx: tracer.step(step.name, step.func, ctx)
+        outputs = func(ctx) or {}
+        missing = [key for key in step.provides if key not in outputs]
+        if missing:
+            raise RuntimeError(f"step {step.name} did not provide {', '.join(missing)}")
+        return outputs, None, buffer
+    except BaseException as e:  # exit() inside a step has to reach the main thread too
+        return {}, e, buffer
+    finally:
+        output.local.buffer = None
+
+
+def run_steps(steps: list, ctx: dict = None, workers: int = 4) -> dict:
+    ctx = {} if ctx is None else ctx
+    # every step implicitly provides its own name
+    providers = {}
+    for step in steps:
+        for key in (step.name,) + tuple(step.provides):
+            providers[key] = step.name
+    for step in steps:
+        for key in step.requires:
+            if key not in providers and key not in ctx:
+                raise ValueError(f"step {step.name} requires {key}, which no step provides")
+
+    output = StepOutput(sys.stdout)
+    sys.stdout = output
+    pending = list(steps)
+    running = {}
+    finished = {}
+    next_to_print = 0
+    available = set(ctx)
+    error = None
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                results = []
+                if error is None:
+                    ready = [step for step in pending if set(step.requires) <= available]
+                    for step in ready:
+                        if not step.interactive:
+                            pending.remove(step)
+                            running[pool.submit(run_step, step, ctx, output)] = step
+                    # prompts never go to the pool: input() has to be on the main thread for Ctrl-C to abort it
+                    # (the pool's threads can't be interrupted and would keep the interpreter from exiting)
+                    for step in [step for step in ready if step.interactive][:1]:
+                        pending.remove(step)
+                        results.append((step, run_step(step, ctx, output)))
+                if not running and not results:
+                    if error is None:
+                        raise ValueError(f"dependency cycle between steps: {', '.join(step.name for step in pending)}")
+                    break
+                if not results:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    results = [(running.pop(future), future.result()) for future in done]
+                for step, (outputs, step_error, buffer) in results:
+                    finished[step.name] = buffer
+                    if step_error is not None:
+                        error = error or step_error
+                        continue
+                    ctx.update(outputs)
+                    available.update(outputs)
+                    available.add(step.name)
+                # print finished steps in declaration order
+                while next_to_print < len(steps) and steps[next_to_print].name in finished:
+                    buffer = finished[steps[next_to_print].name]
+                    if buffer is not None:
+                        with output.lock:
+                            output.stream.write(buffer.getvalue())
+                            output.stream.flush()
+                    next_to_print += 1
+        # a failed step stops the rest, flush whatever finished after it
+        for step in steps[next_to_print:]:
+            buffer = finished.get(step.name)
+            if buffer is not None:
+                output.stream.write(buffer.getvalue())
+        output.stream.flush()
+    finally:
+        sys.stdout = output.stream
+    if error is not None:
+        raise error
+    return ctx
+
+#######################################################################################
+#                                     RECONCILE                                       #
+#######################################################################################
+# Firmware and kernel updates undo parts of the setup: sof-firmware upgrades replace the
+# downstream topologies and wipe the topology links, linux-firmware brings back the max98357a
+# topology, and a new kernel may lack modules. --reconcile re-applies only the platform config
+# and checks every installed kernel, using the hardware snapshot and answers saved by the last
+# full run, so it doesn't probe, ask or touch UCM. Unchanged files are skipped as usual, which
+# makes a run that has nothing to do cheap enough to trigger from every package transaction.
+# --install-hooks sets that up for pacman, apt, dnf and a systemd path unit watching firmware and /boot.
+STATE_FILE = "/var/lib/chromebook-linux-audio/state.json"
+RECONCILE_UNIT = "chromebook-linux-audio-reconcile"
+RECONCILE_WATCH = ("/lib/firmware/intel/sof-tplg", "/lib/firmware/intel/sof-ace-tplg", "/lib/firmware/intel/avs",
+                   "/lib/firmware/amd/sof-tplg", "/boot")
+
+
+# remember what a full run did, for --reconcile
+def save_state(force_avs_install: bool) -> None:
+    state = {"snapshot": get_snapshot().to_dict(), "answers": answers, "force_avs_install": force_avs_install}
+    mkdir(os.path.dirname(host_path(STATE_FILE)), create_parents=True)
+    # an unchanged state shouldn't leave a journal behind
+    sync_data(host_path(STATE_FILE), (json.dumps(state, indent=2, sort_keys=True) + "\n").encode())
+
+
+def load_state() -> dict:
+    try:
+        with open(host_path(STATE_FILE)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        print_error("There is no previous run, run setup-audio without --reconcile, --verify or --install-hooks first")
+        exit(1)
+    except ValueError as e:
+        print_error(f"Unable to load {host_path(STATE_FILE)}: {e}")
+        exit(1)
+
+
+# restore the hardware and answers of the last full run, with the kernel as it is now
+def restore_state(state: dict, args) -> None:
+    set_snapshot(replace(HostSnapshot.from_dict(state["snapshot"]), kernel_release=current_kernel_release()))
+    args.force_avs_install = state["force_avs_install"]
+    # fail before changing anything rather than halfway through the platform config
+    board = match_board(get_snapshot())
+    missing = [name for name in needed_answers(board["platform"], args) if name not in state["answers"]] if board else []
+    if missing:
+        print_error(f"The last run didn't record an answer for {', '.join(missing)}, "
+                    "run setup-audio again without --reconcile to answer it")
+        exit(1)
+    set_answers(state["answers"], True)
+
+
+# hook file (unrooted) -> content, for every package manager/init system present in the root
+def reconcile_hooks(repo_dir: str) -> dict:
+    command = f"cd {shlex.quote(repo_dir)} && {shlex.quote(sys.executable)} setup-audio --reconcile --from-hook"
+    hooks = {}
+    if path_exists(host_path("/etc/pacman.conf")):
+        # package file lists are relative to / and firmware/kernels live in /usr/lib
+        targets = [f"usr{path}/*" for path in RECONCILE_WATCH if path.startswith("/lib")] + ["usr/lib/modules/*/vmlinuz"]
+        hooks["/etc/pacman.d/hooks/90-chromebook-linux-audio.hook"] = (
+            "[Trigger]\nType = Path\nOperation = Install\nOperation = Upgrade\n"
+            + "".join(f"Target = {target}\n" for target in targets)
+            + "\n[Action]\nDescription = Reconciling Chromebook audio setup...\n"
+            f"When = PostTransaction\nExec = /bin/sh -c \"{command}\"\n")
+    if path_exists(host_path("/etc/apt/apt.conf.d")):
+        # a failing hook would fail the whole dpkg run
+        hooks["/etc/apt/apt.conf.d/90chromebook-linux-audio"] = f'DPkg::Post-Invoke {{ "({command}) || true"; }};\n'
+    # only dnf4 with python3-dnf-plugin-post-transaction-actions reads these, dnf5 has a different
+    # actions plugin and format, there (and without the plugin) the systemd path unit covers it
+    if path_exists(host_path("/etc/dnf/plugins/post-transaction-actions.d")):
+        hooks["/etc/dnf/plugins/post-transaction-actions.d/chromebook-linux-audio.action"] = "".join(
+            f"{package}:in:{command}\n" for package in ("alsa-sof-firmware", "linux-firmware", "kernel-core"))
+    if path_exists(host_path("/etc/systemd/system")):
+        hooks[f"/etc/systemd/system/{RECONCILE_UNIT}.path"] = (
+            "[Unit]\nDescription=Reconcile Chromebook audio setup after firmware and kernel updates\n\n[Path]\n"
+            + "".join(f"PathChanged={path}\n" for path in RECONCILE_WATCH)
+            + "TriggerLimitIntervalSec=10s\nTriggerLimitBurst=5\n\n[Install]\nWantedBy=paths.target\n")
+        hooks[f"/etc/systemd/system/{RECONCILE_UNIT}.service"] = (
+            "[Unit]\nDescription=Reconcile Chromebook audio setup after firmware and kernel updates\n\n[Service]\n"
+            f"Type=oneshot\nWorkingDirectory={repo_dir}\nExecStart={sys.executable} setup-audio --reconcile --from-hook\n")
+    return hooks
+
+
+def install_reconcile_hooks(repo_dir: str) -> None:
+    hooks = reconcile_hooks(repo_dir)
+    if not hooks:
+        print_error("No supported package manager or systemd found, run setup-audio --reconcile after updates")
+        return
+    for path, content in hooks.items():
+        mkdir(os.path.dirname(host_path(path)), create_parents=True)
+        write_file_atomic(host_path(path), content.encode())
+        print_status(f"Installed {path}")
+    if f"/etc/systemd/system/{RECONCILE_UNIT}.path" in hooks:
+        # what systemctl enable would do, also works on an image
+        mkdir(host_path("/etc/systemd/system/paths.target.wants"))
+        symlink(f"../{RECONCILE_UNIT}.path", host_path(f"/etc/systemd/system/paths.target.wants/{RECONCILE_UNIT}.path"))
+    if root != "/":
+        print_warning(f"The hooks run the script from {repo_dir}, which has to exist in the image as well")
+
+#######################################################################################
+#                                    DIAGNOSTICS                                      #
+#######################################################################################
+# --diagnose collects what an audio bug report needs into one tar.xz, plus a json summary.
+# Every source runs in its own daemon thread and they all share one time limit. Reads from
+# /proc can block on a wedged driver and commands can hang, so a source that isn't done in
+# time is reported as timed out and left behind instead of holding up the rest.
+# Identical files (UCM trees are full of them) are stored once, with hardlinks for the copies.
+DIAG_TIMEOUT = 5  # seconds
+DIAG_DMESG = re.compile(r"sof|avs|sst|snd|asoc|audio|acp|hda|dsp|firmware|codec|i2s|"
+                        r"max98|rt5\d|rt1\d|da7219|nau88|cs4\d|cs35", re.IGNORECASE)
+DIAG_ASOUND = ("/proc/asound/cards", "/proc/asound/devices", "/proc/asound/pcm", "/proc/asound/modules",
+               "/proc/asound/version", "/proc/asound/card*/id", "/proc/asound/card*/codec#*")
+DIAG_FIRMWARE_DIRS = ("/lib/firmware/intel/sof", "/lib/firmware/intel/sof-tplg", "/lib/firmware/intel/sof-ace-tplg",
+                      "/lib/firmware/intel/sof-ipc4", "/lib/firmware/intel/avs", "/lib/firmware/amd/sof",
+                      "/lib/firmware/amd/sof-tplg")
+
+
+def diag_command(args: list) -> bytes:
+    count_process()
+    return subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=DIAG_TIMEOUT - 1).stdout
+
+
+def diag_dmesg(facts: dict) -> dict:
+    lines = diag_command(["dmesg"]).decode(errors="replace").splitlines()
+    return {"dmesg.txt": "\n".join(line for line in lines if DIAG_DMESG.search(line)).encode()}
+
+
+def diag_read_files(patterns) -> dict:
+    files = {}
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, "rb") as file:
+                files[f"files{path}"] = file.read()
+    return files
+
+
+# every file under a directory of the system being set up, symlinks as "-> target"
+def diag_read_tree(directory: str) -> dict:
+    files = {}
+    for dirpath, dirs, names in os.walk(host_path(directory)):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                data = f"-> {os.readlink(path)}\n".encode()
+            else:
+                with open(path, "rb") as file:
+                    data = file.read()
+            files[f"files{root_path(path)}"] = data
+    return files
+
+
+# which firmware files are there, not their contents
+def diag_firmware(facts: dict) -> dict:
+    lines = []
+    for directory in DIAG_FIRMWARE_DIRS:
+        for dirpath, dirs, names in os.walk(host_path(directory)):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(dirpath, name)
+                if os.path.islink(path):
+                    lines.append(f"{root_path(path)} -> {os.readlink(path)}")
+                else:
+                    lines.append(f"{root_path(path)} {os.path.getsize(path)}")
+    facts["sof_firmware"] = path_exists(host_path("/lib/firmware/intel/sof")) or path_exists(host_path("/lib/firmware/amd/sof"))
+    return {"firmware.txt": "\n".join(lines).encode()}
+
+
+def diag_kernel_config(facts: dict) -> dict:
+    config = load_kernel_config(get_snapshot().kernel_release)
+    if config is None:
+        return {"kernel-config.txt": b"Unable to read kernel config\n"}
+    symbols = kernel_symbols(facts["platform"], facts["codecs"])
+    facts["missing_kconfig"] = [symbol for symbol in symbols if config.get(symbol) not in ("y", "m")]
+    return {"kernel-config.txt": "".join(f"CONFIG_{symbol}={config.get(symbol, 'n')}\n" for symbol in symbols).encode()}
+
+
+# source name -> function(facts) returning archive path -> contents. Live sources read this
+# machine and are skipped when looking at another root
+DIAG_SOURCES = {
+    "dmesg": (diag_dmesg, True),
+    "asound": (lambda facts: diag_read_files(DIAG_ASOUND), True),
+    "modules": (lambda facts: diag_read_files(["/proc/modules"]), True),
+    "aplay": (lambda facts: {"aplay-l.txt": diag_command(["aplay", "-l"])}, True),
+    "modprobe": (lambda facts: diag_read_tree("/etc/modprobe.d"), False),
+    "ucm": (lambda facts: diag_read_tree("/usr/share/alsa/ucm2"), False),
+    "pipewire": (lambda facts: {**diag_read_tree("/etc/wireplumber"), **diag_read_tree("/etc/pipewire")}, False),
+    "firmware": (diag_firmware, False),
+    "kernel_config": (diag_kernel_config, False),
+}
+
+
+# write files (path -> contents) into a tar.xz, identical contents only once, returns how many were
+def write_diag_archive(path: str, files: dict) -> int:
+    first = {}
+    duplicates = 0
+    now = time.time()
+    with tarfile.open(path, "w:xz") as tar:
+        for name, data in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.mtime = now
+            info.mode = 0o644
+            digest = hashlib.sha256(data).digest()
+            if digest in first:
+                info.type = tarfile.LNKTYPE
+                info.linkname = first[digest]
+                tar.addfile(info)
+                duplicates += 1
+            else:
+                first[digest] = name
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return duplicates
+
+
+def diagnose(output: str) -> dict:
+    snapshot = get_snapshot()
+    board = match_board(snapshot)
+    codecs = get_codecs()
+    facts = {"platform": board["platform"] if board else None, "codecs": codecs}
+    results = {}
+    lock = Lock()
+
+    def collect(name, source):
+        start = time.monotonic()
+        try:
+            files, status, error = source(facts), "ok", None
+        except subprocess.TimeoutExpired:
+            files, status, error = {}, "timeout", None
+        except Exception as e:
+            files, status, error = {}, "error", str(e)
+        with lock:
+            results[name] = {"status": status, "error": error, "seconds": round(time.monotonic() - start, 3),
+                             "files": files}
+
+    print_header("Collecting diagnostics")
+    threads = {}
+    for name, (source, live) in DIAG_SOURCES.items():
+        if live and root != "/":
+            results[name] = {"status": "skipped", "error": None, "seconds": 0, "files": {}}
+            continue
+        threads[name] = Thread(target=collect, args=(name, source), daemon=True)
+        threads[name].start()
+    deadline = time.monotonic() + DIAG_TIMEOUT
+    for thread in threads.values():
+        thread.join(max(deadline - time.monotonic(), 0))
+    with lock:
+        for name in threads:
+            results.setdefault(name, {"status": "timeout", "error": None, "seconds": DIAG_TIMEOUT, "files": {}})
+        results = dict(results)
+        facts = dict(facts)
+
+    files = {}
+    for result in results.values():
+        files.update(result.pop("files"))
+    summary = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "board": snapshot.dmi.get("product_family") or snapshot.dmi.get("product_name"),
+        "distro": snapshot.os_release.get("PRETTY_NAME", snapshot.os_release.get("ID", "")),
+        "kernel": snapshot.kernel_release,
+        **facts,
+        "audio_profile": audio_profile(facts["platform"], codecs)[0],
+        "sources": results,
+    }
+    files["summary.json"] = (json.dumps(summary, indent=2) + "\n").encode()
+    summary["archive"] = {"path": output, "files": len(files), "deduplicated": write_diag_archive(output, files)}
+    for name, result in results.items():
+        if result["status"] in ("timeout", "error"):
+            print_error(f"{name}: {result['status']}{': ' + result['error'] if result['error'] else ''}")
+    print_status(f"Collected {len(files)} files ({summary['archive']['deduplicated']} duplicates) into {output}")
+    return summary
+
 #######################################################################################
 #                                   GENERAL FUNCTIONS                                 #
 #######################################################################################
 def check_nix():
-    with open("/etc/os-release") as os:
-        if "ID=nixos" in os.read():
-            print_error("NixOS is not supported")
-            exit(1)
+    if get_snapshot().os_release.get("ID") == "nixos":
+        print_error("NixOS is not supported")
+        exit(1)
 
 def check_arch():
     # dmi doesnt exist on arm chromebooks
-    if not path_exists("/sys/devices/virtual/dmi/id/"):
+    if not get_snapshot().has_dmi:
         print_error("ARM Chromebooks are not supported by this script. See your distro's documentation for audio support status.")
         exit(1)
 
-def check_kernel_config(platform):
-    active_kernel = bash("uname -r")
-    print_header(f"Checking kernel config for {active_kernel}")
-
-    config = ""
-    if path_exists(f"/boot/config-{active_kernel}"):
-        with open(f"/boot/config-{active_kernel}") as file:
-            config = file.read()
-    elif path_exists("/proc/config.gz"):
-        bash(f"zcat /proc/config.gz > /tmp/config-{active_kernel}")
-        with open(f"/tmp/config-{active_kernel}") as file:
-            config = file.read()
-    elif path_exists("/boot/config"):
-        with open("/boot/config") as file:
-            config = file.read()
-    else:
-        # throw hands up in the air crying
-        print_error("Unable to read kernel config!")
-        return
-
+# kernel config symbols needed by a platform and its codecs
+def kernel_symbols(platform, codecs=None):
     # List of kernel config strings for audio hardware
-    module_configs = []
-
-    match platform: # may not want to check for machine drivers here but whatever it works good enough for now
-        case "bdw": # Maybe I should use catpt for bdw instead of sof
-            module_configs += ["SND_SOC_INTEL_BDW_RT5650_MACH", "SND_SOC_INTEL_BDW_RT5677_MACH", "SND_SOC_SOF_BROADWELL"]
-        case "byt":
-            module_configs += ["SND_SOC_INTEL_BYTCR_RT5640_MACH", "SND_SOC_SOF_BAYTRAIL"]
-        case "bsw":
-            module_configs += ["SND_SOC_INTEL_CHT_BSW_RT5645_MACH", "SND_SOC_INTEL_CHT_BSW_MAX98090_TI_MACH", "SND_SOC_SOF_BAYTRAIL"]
-        case "skl" | "kbl" | "apl":
-            module_configs += ["SND_SOC_INTEL_AVS", "SND_SOC_INTEL_AVS_MACH_DA7219", "SND_SOC_INTEL_AVS_MACH_DMIC", "SND_SOC_INTEL_AVS_MACH_HDAUDIO", "SND_SOC_INTEL_AVS_MACH_MAX98927", "SND_SOC_INTEL_AVS_MACH_MAX98357A", "SND_SOC_INTEL_AVS_MACH_MAX98373", "SND_SOC_INTEL_AVS_MACH_NAU8825", "SND_SOC_INTEL_AVS_MACH_RT5514", "SND_SOC_INTEL_AVS_MACH_RT5663", "SND_SOC_INTEL_AVS_MACH_SSM4567"]
-        case "glk":
-            module_configs += ["SND_SOC_SOF_GEMINILAKE", "SND_SOC_INTEL_SOF_CS42L42_MACH", "SND_SOC_INTEL_SOF_RT5682_MACH", "SND_SOC_INTEL_SOF_DA7219_MACH"]
-        case "cml":
-            module_configs += ["SND_SOC_SOF_COMETLAKE", "SND_SOC_INTEL_SOF_RT5682_MACH", "SND_SOC_INTEL_SOF_DA7219_MACH"]
-        case "tgl":
-            module_configs += ["SND_SOC_SOF_TIGERLAKE", "SND_SOC_INTEL_SOF_RT5682_MACH"]
-        case "jsl":
-            module_configs += ["SND_SOC_SOF_ICELAKE", "SND_SOC_INTEL_SOF_RT5682_MACH", "SND_SOC_INTEL_SOF_DA7219_MACH", "SND_SOC_INTEL_SOF_CS42L42_MACH"]
-        case "adl":
-            module_configs += ["SND_SOC_SOF_ALDERLAKE", "SND_SOC_INTEL_SOF_CS42L42_MACH", "SND_SOC_INTEL_SOF_DA7219_MACH", "SND_SOC_INTEL_SOF_RT5682_MACH", "SND_SOC_INTEL_SOF_NAU8825_MACH", "SND_SOC_INTEL_SOF_SSP_AMP_MACH"]
-        case "mtl":
-            module_configs += [""] # TODO: fill this out
-        case "st":
-            module_configs += ["SND_SOC_AMD_ACP", "SND_SOC_AMD_CZ_DA7219MX98357_MACH"]
-        case "pco":
-            module_configs += ["SND_SOC_AMD_ACP3x", "SND_SOC_AMD_RV_RT5682_MACH"]
-        case "czn":
-            module_configs += [""] # TODO: fill this out
-        case "mdn":
-            module_configs += ["SND_SOC_SOF_AMD_REMBRANDT", "SND_AMD_ASOC_REMBRANDT"]
-
-    for codec in get_codecs():
-        match codec:
-            case "max98357a" | "max98360a":
-                module_configs.append("SND_SOC_MAX98357A")
-            case "max98373":
-                module_configs.append("SND_SOC_MAX98373")
-            case "max98927":
-                module_configs.append("SND_SOC_MAX98927")
-            case "max98390":
-                module_configs.append("SND_SOC_MAX98390")
-            case "rt1011":
-                module_configs.append("SND_SOC_RT1011")
-            case "rt1015":
-                module_configs.append("SND_SOC_RT1015")
-            case "rt1015p" | "rt1019p":
-                module_configs.append("SND_SOC_RT1015P")
-            case "rt1019":
-                module_configs.append("SND_SOC_RT1019")
-            case "rt5682":
-                module_configs.append("SND_SOC_RT5682")
-            case "rt5682s":
-                module_configs.append("SND_SOC_RT5682S")
-            case "rt5663":
-                module_configs.append("SND_SOC_RT5663")
-            case "cs42l42":
-                module_configs.append("SND_SOC_CS42L42")
-            case "da7219":
-                module_configs.append("SND_SOC_DA7219")
-            case "nau8825":
-                module_configs.append("SND_SOC_NAU8825")
-            case "max98090":
-                module_configs.append("SND_SOC_MAX98090")
-            case "rt5650":
-                module_configs.append("SND_SOC_RT5645")
-            case "rt5677":
-                module_configs.append("SND_SOC_RT5677")
-            case "rt5514":
-                module_configs.append("SND_SOC_RT5514")
-            case "CrosEC audio codec":
-                module_configs.append("SND_SOC_CROS_EC_CODEC")
-    failed = 0
-    for module in module_configs:
-        if not f"{module}=" in config:
-            failed = 1
-            print_error(f"Warning: Kernel is missing module '{module}', audio may not work.")
-    if not failed:
-        print_status("Kernel config check passed")
+    db = board_db()
+    # may not want to check for machine drivers here but whatever it works good enough for now
+    module_configs = list(db["platforms"].get(platform, {}).get("kconfig", []))
+    if codecs is None:
+        codecs = get_codecs()
+    for codec in codecs:
+        module_configs += db["codec_names"].get(codec, {}).get("kconfig", [])
+    return module_configs
+
+# where the config of a kernel release may live, depending on the distro
+def kernel_config_paths(release):
+    paths = [f"/boot/config-{release}", f"/lib/modules/{release}/config", f"/lib/modules/{release}/build/.config"]
+    # these only describe the running kernel
+    if release == get_snapshot().kernel_release and root == "/":
+        paths += ["/proc/config.gz", "/boot/config"]
+    return [host_path(path) for path in paths]
+
+# sort key for kernel releases, numerically so 6.10 comes after 6.9 ("6.10.2-arch1-1" -> 6, 10, 2, "arch", 1, 1)
+def kernel_version_key(release):
+    return [(1, int(part), "") if part.isdigit() else (0, 0, part) for part in re.findall(r"\d+|[^\d.\-+_~]+", release)]
+
+# every kernel installed on the system, newest first
+def installed_kernels():
+    kernels = set()
+    with contextlib.suppress(FileNotFoundError), os.scandir(host_path("/lib/modules")) as entries:
+        kernels.update(entry.name for entry in entries if entry.is_dir())
+    with contextlib.suppress(FileNotFoundError), os.scandir(host_path("/boot")) as entries:
+        kernels.update(entry.name[7:] for entry in entries if entry.name.startswith("config-"))
+    return sorted(kernels, key=kernel_version_key, reverse=True)
+
+_kernel_configs = {}
+
+# parse a plain or gzipped kernel config into a dict of symbol (without CONFIG_) -> value
+# results are cached by path and mtime
+def parse_kernel_config(path):
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key in _kernel_configs:
+        return _kernel_configs[key]
+    config = {}
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", errors="replace") as file:
+        for line in file:
+            if line.startswith("CONFIG_"):
+                symbol, _, value = line.rstrip("\n").partition("=")
+                config[symbol[7:]] = value
+            elif line.startswith("# CONFIG_") and line.endswith(" is not set\n"):
+                config[line[9:-12]] = "n"
+    _kernel_configs[key] = config
+    return config
+
+def load_kernel_config(release):
+    for path in kernel_config_paths(release):
+        if path_exists(path):
+            return parse_kernel_config(path)
+    return None
+
+ACPI_ALIAS = re.compile(r"acpi\*:([A-Za-z0-9]+):\*")
+
+# snd-soc-rt5682.ko.zst -> snd_soc_rt5682
+def module_name(path):
+    name = os.path.basename(path)
+    name = name[:name.index(".ko")] if ".ko" in name else name
+    return name.replace("-", "_")
+
+_module_indexes = {}
+
+# load modules.builtin, modules.dep and modules.alias of a kernel once into sets/dicts
+# returns None if the kernel has no modules directory
+def load_module_index(release):
+    if release in _module_indexes:
+        return _module_indexes[release]
+    moddir = host_path(f"/lib/modules/{release}")
+    index = None
+    if path_exists(f"{moddir}/modules.dep"):
+        index = {"builtin": set(), "modules": set(), "acpi": {}, "acpi_patterns": []}
+        for line in read_host_file(f"{moddir}/modules.builtin").splitlines():
+            index["builtin"].add(module_name(line))
+        for line in read_host_file(f"{moddir}/modules.dep").splitlines():
+            index["modules"].add(module_name(line.split(":", 1)[0]))
+        for alias_file in ("modules.alias", "modules.builtin.alias"):
+            for line in read_host_file(f"{moddir}/{alias_file}").splitlines():
+                parts = line.split()
+                if len(parts) != 3 or not parts[1].startswith("acpi"):
+                    continue
+                match = ACPI_ALIAS.fullmatch(parts[1])
+                if match:
+                    index["acpi"].setdefault(match.group(1).upper(), set()).add(parts[2])
+                else:
+                    index["acpi_patterns"].append((parts[1], parts[2]))
+    _module_indexes[release] = index
+    return index
+
+# drivers whose modalias matches an ACPI HID
+def hid_drivers(index, hid):
+    drivers = set(index["acpi"].get(hid.upper(), ()))
+    for pattern, module in index["acpi_patterns"]:
+        if fnmatch.fnmatchcase(f"acpi:{hid}:", pattern):
+            drivers.add(module)
+    return drivers
+
+# symbols that are enabled as modules but whose module isn't installed (split packages etc.)
+def missing_kernel_modules(index, config, symbols):
+    missing = []
+    for symbol in symbols:
+        modules = board_db()["kconfig_modules"].get(symbol)
+        if config.get(symbol) != "m" or not modules:
+            continue
+        if not any(module in index["modules"] or module in index["builtin"] for module in modules):
+            missing.append(symbol)
+    return missing
+
+# check_drivers also looks for a driver alias for every codec found, codecs without kconfig symbols
+# in the board database (e.g. cs35l53) aren't expected to have an upstream driver and are skipped
+def check_kernel_config(platform, codecs=None, all_kernels=False, check_drivers=False):
+    module_configs = kernel_symbols(platform, codecs)
+    active_kernel = get_snapshot().kernel_release
+    kernels = [active_kernel]
+    if all_kernels:
+        # users often upgrade the kernel right before running this, so check what will boot next too
+        kernels += [kernel for kernel in installed_kernels() if kernel != active_kernel]
+
+    with ThreadPoolExecutor() as pool:
+        configs = list(pool.map(load_kernel_config, kernels))
+        indexes = list(pool.map(load_module_index, kernels))
+
+    if codecs is None:
+        codecs = get_codecs()
+    codec_entries = board_db()["codecs"]
+    hids = [hid for hid, codec in codec_table().items() if codec in codecs and codec_entries[hid]["kconfig"]]
+
+    for kernel, config, index in zip(kernels, configs, indexes):
+        print_header(f"Checking kernel config for {kernel}")
+        if config is None:
+            # throw hands up in the air crying
+            print_error("Unable to read kernel config!")
+            continue
+        failed = 0
+        for module in module_configs:
+            if config.get(module) not in ("y", "m"):
+                failed = 1
+                print_error(f"Warning: Kernel is missing module '{module}', audio may not work.")
+        if index is not None:
+            for module in missing_kernel_modules(index, config, module_configs):
+                failed = 1
+                print_error(f"Warning: Module for '{module}' is enabled but not installed, audio may not work.")
+            for hid in hids if check_drivers else []:
+                if not hid_drivers(index, hid):
+                    failed = 1
+                    print_error(f"Warning: No driver for {codec_table()[hid]} ({hid}) found, audio may not work.")
+        if not failed:
+            print_status("Kernel config check passed")
 
 def get_codecs():
     # Get a list of codecs/amps via sysfs
     print_header("Detecting codecs")
-    codec_table = {
-        # Speaker amps
-        "MX98357A": "max98357a",
-        "MX98360A": "max98360a",
-        "MX98373": "max98373",
-        "MX98927": "max98927",
-        "MX98390": "max98390",
-        "10EC1011": "rt1011",
-        "10EC1015": "rt1015",
-        "RTL1015": "rt1015p",
-        "10EC1019": "rt1019",
-        "RTL1019": "rt1019p",
-        "103C8C08": "cs35l53",
-        # Headphone codecs
-        "10EC5682": "rt5682",
-        "RTL5682": "rt5682s",
-        "10EC5663": "rt5663",
-        "10134242": "cs42l42",
-        "DLGS7219": "da7219",
-        "10158825": "nau8825",
-        # Speaker/Headphone combo codecs
-        "193C9890": "max98090",
-        "10EC5650": "rt5650",
-        "RT5677CE": "rt5677",
-        # Mic codecs
-        "10EC5514": "rt5514",
-        "GOOG0013": "CrosEC audio codec"
-    }
 
     codecs = []
+    acpi_devices = get_snapshot().acpi_devices
 
-    for codec in codec_table:
-        if path_exists(f"/sys/bus/acpi/devices/{codec}:00"):
-            print_status(f"Found {codec_table[codec]}")
-            codecs.append(codec_table[codec])
+    for hid, codec in codec_table().items():
+        if f"{hid}:00" in acpi_devices:
+            print_status(f"Found {codec}")
+            codecs.append(codec)
 
     return codecs
 
-def install_ucm(branch):
-    print_header("Installing UCM configuration")
-    try:
-        bash("rm -rf /tmp/alsa-ucm-conf-cros")
-        bash(f"git clone --depth 1 https://github.com/WeirdTreeThing/alsa-ucm-conf-cros -b {branch} /tmp/alsa-ucm-conf-cros")
-    except:
-        print_error("Error: Failed to clone UCM repo")
-        exit(1)
+def install_ucm_files(ucm_dir, platform="", codecs=None, full=False):
+    if full or not codecs:
+        cpdir(f"{ucm_dir}/ucm2", host_path("/usr/share/alsa/ucm2/"))
+        cpdir(f"{ucm_dir}/overrides", host_path("/usr/share/alsa/ucm2/conf.d"))
+        return
 
-    cpdir("/tmp/alsa-ucm-conf-cros/ucm2", "/usr/share/alsa/ucm2/")
-    cpdir("/tmp/alsa-ucm-conf-cros/overrides", "/usr/share/alsa/ucm2/conf.d")
+    ucm2_files, override_files = select_ucm_files(ucm_dir, platform, codecs)
+    print_status(f"Installing {len(ucm2_files) + len(override_files)} UCM files for {platform} ({', '.join(codecs)})")
+    cpfiles(f"{ucm_dir}/ucm2", host_path("/usr/share/alsa/ucm2"), ucm2_files)
+    cpfiles(f"{ucm_dir}/overrides", host_path("/usr/share/alsa/ucm2/conf.d"), override_files)
+
+# the steps of a full setup-audio run, see run_steps()
+def setup_steps(args):
+    def fetch_ucm_step(ctx):
+        print_header("Fetching UCM configuration")
+        return {"ucm_dir": fetch_ucm(args.branch_name[0], args.ucm_source)}
+
+    # Install downstream UCM configuration
+    def install_ucm_step(ctx):
+        print_header("Installing UCM configuration")
+        install_ucm_files(ctx["ucm_dir"], ctx["platform"], ctx["codecs"], args.full_ucm)
+
+    # Sometimes the alsa save/restore service doesn't init the sound card for some reason, so do it here instead
+    # This won't work for soundcards which don't currently exist, such as ones that need firmware installed
+    # by this script, but those aren't known to have this issue
+    # the exit status is ignored because that command will return a non-zero value for some reason
+    def init_sound_card(ctx):
+        # there is no sound card to init when setting up another root
+        if root != "/":
+            return
+        print_status("Initializing sound card")
+        run(["alsactl", "init"], check=False)
+
+    # Read-only steps (UCM download, kernel config parsing) overlap with the questions platform_config may ask.
+    # Everything that changes the system waits for it, so aborting at a prompt leaves the system untouched.
+    return [
+        Step("platform", lambda ctx: {"platform": get_platform()}, provides=("platform",)),
+        Step("codecs", lambda ctx: {"codecs": get_codecs()}, provides=("codecs",)),
+        # Platform specific configuration, may ask questions
+        Step("platform_config", lambda ctx: platform_config(ctx["platform"], args), requires=("platform",),
+             interactive=True),
+        Step("fetch_ucm", fetch_ucm_step, provides=("ucm_dir",)),
+        Step("install_ucm", install_ucm_step, requires=("ucm_dir", "platform", "codecs", "platform_config")),
+        # Check currently running kernel for all required modules
+        Step("kernel_config", lambda ctx: check_kernel_config(ctx["platform"], ctx["codecs"], args.all_kernels,
+                                                              args.check_drivers),
+             requires=("platform", "codecs")),
+        # Wireplumber/pipewire latency settings, more headroom fixes instability and crashes on various devices
+        Step("audio_profile", lambda ctx: install_audio_profile(ctx["platform"], ctx["codecs"]),
+             requires=("platform", "codecs", "platform_config")),
+        # everything queued by the steps above, in one transaction
+        Step("packages", lambda ctx: install_queued_packages(), requires=("platform_config",)),
+        Step("alsactl", init_sound_card, requires=("packages", "install_ucm", "audio_profile")),
+    ]
+
+# firmware/kernel part of setup_steps(), for --reconcile
+def reconcile_steps(args):
+    return [
+        Step("platform", lambda ctx: {"platform": get_platform()}, provides=("platform",)),
+        Step("codecs", lambda ctx: {"codecs": get_codecs()}, provides=("codecs",)),
+        Step("platform_config", lambda ctx: platform_config(ctx["platform"], args), requires=("platform",)),
+        Step("packages", lambda ctx: install_queued_packages(not args.from_hook), requires=("platform_config",)),
+        Step("kernel_config", lambda ctx: check_kernel_config(ctx["platform"], ctx["codecs"], True, args.check_drivers),
+             requires=("platform", "codecs")),
+    ]
 
 def check_os_release():
-    release = ""
-    with open("/etc/os-release", "r") as rel:
-        release = rel.read()
+    release = get_snapshot().os_release_raw
     if "noble" in release or "jammy" in release or "plucky" in release:
         print_error("Warning: Your distro is not officially supported. Expect Issues.")
         print_error("Please try a supported distro first before opening an issue. See the README for a list of supported distros.")
@@ -0,0 +1,169 @@
+# Schema test for boards.json: the database has to validate, and its indexes have to give the same
+# platforms, actions and codecs as the match blocks in get_platform(), platform_config() and get_codecs()
+# did before the board knowledge moved into the database.
+
+import json
+import os
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+os.chdir(REPO)
+
+from functions import *
+
+# product_family -> platform
+FAMILIES = {
+    "intel_strago": "bsw",
+    "google_glados": "skl",
+    "google_coral": "apl",
+    "google_reef": "apl",
+    "google_atlas": "kbl",
+    "google_poppy": "kbl",
+    "google_nami": "kbl",
+    "google_nautilus": "kbl",
+    "google_nocturne": "kbl",
+    "google_rammus": "kbl",
+    "google_soraka": "kbl",
+    "google_eve": "kbl",
+    "google_fizz": "kbl",
+    "google_kalista": "kbl",
+    "google_endeavour": "kbl",
+    "google_octopus": "glk",
+    "google_hatch": "cml",
+    "google_puff": "cml",
+    "google_dedede": "jsl",
+    "google_volteer": "tgl",
+    "google_brya": "adl",
+    "google_brask": "adl",
+    "google_nissa": "adl",
+    "google_rex": "mtl",
+    "google_kahlee": "st",
+    "google_zork": "pco",
+    "google_guybrush": "czn",
+    "google_skyrim": "mdn",
+}
+
+# product_name -> platform, for boards without a product_family
+PRODUCTS = {
+    "cyan": "bsw",
+    "samus": "bdw",
+    "buddy": "bdw",
+}
+
+# pci id of 00:00.0 -> platform
+PCI_IDS = {
+    "0x0f00": "byt",
+    "0x4e22": "jsl",
+    "0x4e12": "jsl",
+    "0x4e26": "jsl",
+}
+
+# platform -> what platform_config() did for it
+ACTIONS = {
+    "bdw": ["sst_atom_config"],
+    "byt": ["sst_atom_config"],
+    "bsw": ["sst_atom_config"],
+    "skl": ["avs_config"],
+    "kbl": ["avs_config"],
+    "apl": ["avs_config"],
+    "glk": ["check_sof_fw"],
+    "cml": ["check_sof_fw"],
+    "tgl": ["check_sof_fw"],
+    "jsl": ["check_sof_fw"],
+    "adl": ["adl_sof_config", "check_sof_fw"],
+    "mtl": ["mtl_sof_config", "check_sof_fw"],
+    "st": ["st_warning"],
+    "pco": [],
+    "czn": [],
+    "mdn": ["mdn_config"],
+}
+
+# ACPI HID -> codec name
+CODECS = {
+    "MX98357A": "max98357a",
+    "MX98360A": "max98360a",
+    "MX98373": "max98373",
+    "MX98927": "max98927",
+    "MX98390": "max98390",
+    "10EC1011": "rt1011",
+    "10EC1015": "rt1015",
+    "RTL1015": "rt1015p",
+    "10EC1019": "rt1019",
+    "RTL1019": "rt1019p",
+    "103C8C08": "cs35l53",
+    "10EC5682": "rt5682",
+    "RTL5682": "rt5682s",
+    "10EC5663": "rt5663",
+    "10134242": "cs42l42",
+    "DLGS7219": "da7219",
+    "10158825": "nau8825",
+    "193C9890": "max98090",
+    "10EC5650": "rt5650",
+    "RT5677CE": "rt5677",
+    "10EC5514": "rt5514",
+    "GOOG0013": "CrosEC audio codec",
+}
+
+
+def snapshot(product_family="", product_name="", pci_id="", acpi_devices=()):
+    return HostSnapshot(dmi={"sys_vendor": "Google", "product_family": product_family, "product_name": product_name,
+                             "board_name": product_name},
+                        pci_id=pci_id, acpi_devices=acpi_devices, os_release={}, os_release_raw="", kernel_release="",
+                        has_dmi=True, has_cros_ec=True)
+
+
+def test_board_db_is_valid():
+    with open(BOARD_DB) as file:
+        db = json.load(file)
+    assert validate_board_db(db) == []
+
+
+def test_validation_catches_errors():
+    with open(BOARD_DB) as file:
+        db = json.load(file)
+    db["families"]["google_unknown"] = {"platform": "nope"}
+    db["platforms"]["adl"]["actions"].append("format_disk")
+    del db["kconfig_modules"]
+    assert validate_board_db(db) == ["missing section 'kconfig_modules'"]
+    db["kconfig_modules"] = {}
+    assert validate_board_db(db) == ["platforms.adl: unknown action 'format_disk'",
+                                     "families.google_unknown: unknown platform 'nope'"]
+
+
+def test_families():
+    assert {family: board["platform"] for family, board in board_db()["families"].items()} == FAMILIES
+    for family, platform in FAMILIES.items():
+        # product_family wins over the other identifiers, and is matched case-insensitively
+        board = match_board(snapshot(product_family=family.upper(), product_name="cyan", pci_id="0x0f00"))
+        assert board["platform"] == platform
+
+
+def test_products():
+    assert {product: board["platform"] for product, board in board_db()["products"].items()} == PRODUCTS
+    for product, platform in PRODUCTS.items():
+        assert match_board(snapshot(product_name=product, pci_id="0x0f00"))["platform"] == platform
+
+
+def test_pci_ids():
+    assert {pci_id: board["platform"] for pci_id, board in board_db()["pci_ids"].items()} == PCI_IDS
+    for pci_id, platform in PCI_IDS.items():
+        assert match_board(snapshot(product_name="unknown", pci_id=pci_id))["platform"] == platform
+
+
+def test_unknown_board():
+    assert match_board(snapshot(product_family="google_unknown")) is None
+    assert match_board(snapshot(product_name="unknown", pci_id="0x1234")) is None
+
+
+def test_actions():
+    platforms = board_db()["platforms"]
+    assert {platform: entry["actions"] for platform, entry in platforms.items()} == ACTIONS
+    for entry in platforms.values():
+        assert all(action in PLATFORM_ACTIONS for action in entry["actions"])
+
+
+def test_codecs():
+    assert codec_table() == CODECS
+    assert codec_hids(["rt5682", "MX98357A", "da7219"]) == ["10EC5682", "MX98357A", "DLGS7219"]
+    assert codec_hids(["rt9999"]) is None